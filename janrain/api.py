@@ -1,8 +1,95 @@
+from collections import deque
+import copy
 from functools import partial
+from multiprocessing.pool import ThreadPool
 import json
+import random
+import threading
+import time
+import cookielib
 import requests
 import urlparse
 
+from django.conf import settings
+
+from janrain import codec, instrumentation
+from janrain.cache import entity_cache_from_settings
+from janrain.ratelimit import BATCH, INTERACTIVE, rate_limiter_from_settings
+
+_session = None
+_session_used = 0
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+        Returns the ``requests.Session`` shared by every JanrainClient in this
+        process. Connections are kept alive and pooled per host. Cookies are
+        refused, so none set in one user's call is sent with the next. The
+        pool is sized from these settings:
+
+        ``JANRAIN_HTTP_POOL_CONNECTIONS``: number of hosts to keep pools for
+        ``JANRAIN_HTTP_POOL_MAXSIZE``: connections kept alive per host
+        ``JANRAIN_HTTP_POOL_BLOCK``: wait for a free connection instead of
+            opening an extra, unpooled one
+        ``JANRAIN_HTTP_IDLE_TIMEOUT``: seconds a pool may sit unused before
+            its connections are dropped and reopened
+
+        :returns: requests.Session
+    """
+    global _session, _session_used
+
+    idle_timeout = getattr(settings, 'JANRAIN_HTTP_IDLE_TIMEOUT', 60)
+    with _session_lock:
+        now = time.time()
+        if _session is not None and idle_timeout and now - _session_used > idle_timeout:
+            # the far end has most likely hung up on us by now; start fresh
+            # rather than finding out one stale socket at a time.
+            _session.close()
+            _session = None
+
+        if _session is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=getattr(settings, 'JANRAIN_HTTP_POOL_CONNECTIONS', 10),
+                pool_maxsize=getattr(settings, 'JANRAIN_HTTP_POOL_MAXSIZE', 10),
+                pool_block=getattr(settings, 'JANRAIN_HTTP_POOL_BLOCK', False),
+            )
+            _session = requests.Session()
+            _session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+
+        _session_used = now
+        return _session
+
+def reset_session():
+    """
+        Closes the shared session. The next request opens a new one, picking
+        up any changed pool settings.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+        Returns the worker thread pool shared by AsyncJanrainClient. Its size
+        is ``JANRAIN_WORKER_POOL_SIZE`` (default 10) and it's created on first
+        use.
+
+        :returns: multiprocessing.pool.ThreadPool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(getattr(settings, 'JANRAIN_WORKER_POOL_SIZE', 10))
+        return _pool
+
+
 class APIException(Exception):
     def __init__(self, method, response):
         self.method = method
@@ -12,13 +99,241 @@ class APIException(Exception):
         return "janrain %s return error response: %s" % (self.method, json.dumps(self.response))
 
 
+class CircuitOpenException(APIException):
+    """
+        Raised without contacting Janrain while the circuit breaker for its
+        host is open.
+    """
+
+
+class CircuitBreaker(object):
+    """
+        Stops calls to a host that keeps failing. After ``threshold``
+        consecutive failures (connection errors, timeouts, 5xx) the breaker
+        opens and calls fail fast with CircuitOpenException. Once ``reset``
+        seconds have passed a single trial call is let through; its outcome
+        closes or re-opens the breaker. A trial that never reports back
+        lapses after another ``reset`` seconds and a new one is let through.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold=5, reset=30):
+        self.threshold = threshold
+        self.reset = reset
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self, method):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = time.time()
+            if now - self.opened_at >= self.reset:
+                # OPEN long enough, or a HALF_OPEN trial that never finished
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return
+        raise CircuitOpenException(method, dict(stat='error', error='circuit_open'))
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def status(self):
+        return dict(state=self.state, failures=self.failures, opened_at=self.opened_at)
+
+class SingleFlight(object):
+    """
+        Collapses concurrent calls with the same key into one: the first
+        caller runs the function, the rest wait for it and get a deep copy of
+        its result, or the same exception, so each may modify what it gets.
+    """
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = func(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        return len(self._calls)
+
+single_flight = SingleFlight()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(url):
+    """
+        Returns the process-wide CircuitBreaker for url's host, configured by
+        ``JANRAIN_BREAKER_THRESHOLD`` (default 5 failures) and
+        ``JANRAIN_BREAKER_RESET`` (default 30 seconds).
+    """
+    host = urlparse.urlsplit(url).netloc
+    try:
+        return _breakers[host]
+    except KeyError:
+        with _breakers_lock:
+            if host not in _breakers:
+                _breakers[host] = CircuitBreaker(
+                    threshold=getattr(settings, 'JANRAIN_BREAKER_THRESHOLD', 5),
+                    reset=getattr(settings, 'JANRAIN_BREAKER_RESET', 30),
+                )
+            return _breakers[host]
+
+def breaker_status():
+    """
+        State of every circuit breaker, for monitoring.
+
+        :returns: dict of host to dict(state, failures, opened_at)
+    """
+    return dict((host, breaker.status()) for host, breaker in _breakers.items())
+
+def clear_breakers():
+    """
+        Forgets every host's breaker.
+    """
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def iter_results(response, method, key='results', chunk_size=65536):
+    """
+        Decodes a JSON response body incrementally, yielding the members of
+        its top-level ``key`` array one at a time. Only the record being
+        decoded and one chunk of the body are held in memory, however large
+        the response.
+
+        Raises APIException once the body is read if it has no ``key`` array
+        and its ``stat`` isn't ``ok``.
+
+        :param response: a ``requests`` response opened with ``stream=True``
+        :param method: API path, for error reporting
+    """
+    decoder = json.JSONDecoder()
+    chunks = response.iter_content(chunk_size)
+    state = dict(buf='', idx=0, done=False)
+
+    def fill():
+        # append the next chunk, dropping what's already been decoded
+        if state['done']:
+            return False
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            state['done'] = True
+            return False
+        state['buf'] = state['buf'][state['idx']:] + chunk
+        state['idx'] = 0
+        return True
+
+    def skip(chars=' \t\r\n'):
+        while True:
+            buf, idx = state['buf'], state['idx']
+            while idx < len(buf) and buf[idx] in chars:
+                idx += 1
+            state['idx'] = idx
+            if idx < len(buf) or not fill():
+                return buf[idx:idx + 1]
+
+    def expect(char):
+        if skip() != char:
+            raise APIException(method, 'malformed response, expected %r' % char)
+        state['idx'] += 1
+
+    def value():
+        skip()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(state['buf'], state['idx'])
+            except ValueError:
+                if fill():
+                    continue
+                raise APIException(method, 'malformed response')
+            # a number at the very end of the buffer may be cut short
+            if end == len(state['buf']) and fill():
+                continue
+            state['idx'] = end
+            return obj
+
+    fields = {}
+    found = False
+    try:
+        expect('{')
+        while skip(' \t\r\n,') not in ('}', ''):
+            name = value()
+            expect(':')
+            if name == key and skip() == '[':
+                found = True
+                state['idx'] += 1
+                while skip(' \t\r\n,') not in (']', ''):
+                    yield value()
+                expect(']')
+            else:
+                fields[name] = value()
+    finally:
+        response.close()
+
+    if not found and fields.get('stat') != 'ok':
+        raise APIException(method, fields)
+
+
 class JanrainClient(object):
     APIException = APIException
 
-    def __init__(self, client_id, client_secret, api_url):
+    def __init__(self, client_id, client_secret, api_url, entity_cache=None, rate_limiter=None):
         self.url = api_url
         self.client_id = client_id
         self.client_secret = client_secret
+        # optional janrain.cache.EntityCache for uuid/type_name entity reads
+        self.entity_cache = entity_cache
+        # optional janrain.ratelimit.RateLimiter every call goes through
+        self.rate_limiter = rate_limiter
+
+    # Engage - auth_info
+    def auth_info(self, token):
+        return self._make_request('auth_info', method='post', data=dict(
+            apiKey=self.client_secret,
+            token=token,
+        ), priority=INTERACTIVE)
 
     # Capture - Oauth
     def oauth_token(self, code, redirect_uri, grant_type='authorization_code'):
@@ -28,41 +343,171 @@ class JanrainClient(object):
             grant_type=grant_type,
             client_id=self.client_id,
             client_secret=self.client_secret
-        ))
+        ), priority=INTERACTIVE)
+
+    def refresh_token(self, refresh_token):
+        return self._make_request('oauth/token', method='post', data=dict(
+            refresh_token=refresh_token,
+            grant_type='refresh_token',
+            client_id=self.client_id,
+            client_secret=self.client_secret
+        ), priority=INTERACTIVE)
 
     # Capture - Entity
     def entity(self, uuid=None, type_name=None, access_token=None):
         if access_token:
             return self._make_request('entity',
-                headers=dict(Authorization='OAuth %s' % access_token)
+                headers=dict(Authorization='OAuth %s' % access_token),
+                priority=INTERACTIVE,
             )
         elif all([self.client_id, self.client_secret, type_name, uuid]):
+            if self.entity_cache is not None:
+                response = self.entity_cache.get(uuid, type_name)
+                if response is not None:
+                    return response
+
             # TODO support other way to call entity
-            return self._make_request('entity', method='post', data=dict(
+            response = self._make_request('entity', method='post', idempotent=True, data=dict(
                 client_id=self.client_id,
                 client_secret=self.client_secret,
                 type_name=type_name,
                 uuid=uuid
             ))
+
+            if self.entity_cache is not None and response.get('stat') == 'ok':
+                self.entity_cache.set(uuid, type_name, response)
+            return response
         else:
             raise ValueError('Bad invocation of entity; needs either (client_id and client_secret) or access_token')
 
     def entity_update(self, uuid, type_name, update):
-        return self._make_request('entity.update', method='post', data=dict(
+        response = self._make_request('entity.update', method='post', data=dict(
             client_id=self.client_id,
             client_secret=self.client_secret,
             type_name=type_name,
             uuid=uuid,
-            value=json.dumps(update)
+            value=codec.dumps(update)
         ))
 
+        if self.entity_cache is not None:
+            if response.get('stat') == 'ok':
+                self.entity_cache.update(uuid, type_name, update)
+            else:
+                self.entity_cache.invalidate(uuid, type_name)
+        return response
+
+    def entity_find(self, type_name, filter=None, attributes=None, first_result=0, max_results=100, stream=False):
+        """
+        One page of an entity.find query.
+
+        :param filter: Capture filter expression, e.g. "lastUpdated > '2012-01-01'"
+        :param attributes: optional list of attribute names to return
+        :param stream: yield the records in ``results`` as they are decoded
+            instead of returning the whole response
+        """
+        data = dict(
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            type_name=type_name,
+            first_result=first_result,
+            max_results=max_results,
+        )
+        if filter:
+            data['filter'] = filter
+        if attributes:
+            data['attributes'] = codec.dumps(attributes)
+        return self._make_request('entity.find', method='post', data=data, stream=stream,
+            idempotent=True)
+
+    def iter_entities(self, type_name, filter=None, attributes=None, page_size=100, first_result=0):
+        """
+        Walks every entity matching an entity.find query. While the caller
+        works through one page the next is already being fetched on the
+        shared worker pool.
+
+        :param filter: Capture filter expression
+        :param attributes: optional list of attribute names to return
+        :param first_result: offset to start from, e.g. to resume a job
+        :returns: generator of entity dicts
+        """
+        def fetch(offset):
+            return get_pool().apply_async(self.entity_find, (type_name,), dict(
+                filter=filter,
+                attributes=attributes,
+                first_result=offset,
+                max_results=page_size,
+            ))
+
+        page = fetch(first_result)
+        while page is not None:
+            response = page.get()
+            if response.get('stat') != 'ok':
+                raise APIException('entity.find', response)
+
+            results = response.get('results', [])
+            first_result += len(results)
+            page = fetch(first_result) if len(results) == page_size else None
+            for record in results:
+                yield record
+
+    def entity_many(self, uuids, type_name, concurrency=10):
+        """
+        Reads many entities at once, ``concurrency`` calls at a time.
+
+        :param uuids: iterable of uuids; consumed lazily
+        :returns: generator of (uuid, response, exception) in input order;
+            exactly one of response and exception is None
+        """
+        return self._fan_out(
+            ((uuid, self.entity, (uuid, type_name)) for uuid in uuids),
+            concurrency
+        )
+
+    def entity_update_many(self, updates, type_name, concurrency=10):
+        """
+        Applies many entity updates at once, ``concurrency`` calls at a time.
+
+        :param updates: iterable of (uuid, update) pairs; consumed lazily
+        :returns: generator of (uuid, response, exception) in input order;
+            exactly one of response and exception is None
+        """
+        return self._fan_out(
+            ((uuid, self.entity_update, (uuid, type_name, update)) for uuid, update in updates),
+            concurrency
+        )
+
+    def _fan_out(self, calls, concurrency):
+        """
+            Runs (key, func, args) calls on a private pool of ``concurrency``
+            threads and yields their outcomes in order. Only a small window of
+            calls is ever queued, so memory stays flat however many there are.
+        """
+        pool = ThreadPool(concurrency)
+        pending = deque()
+
+        def collect(key, result):
+            try:
+                return key, result.get(), None
+            except Exception as e:
+                return key, None, e
+
+        try:
+            for key, func, args in calls:
+                pending.append((key, pool.apply_async(func, args)))
+                # keep a second round queued so workers never wait on us
+                if len(pending) >= concurrency * 2:
+                    yield collect(*pending.popleft())
+            while pending:
+                yield collect(*pending.popleft())
+        finally:
+            pool.terminate()
 
     # Capture - clients/list
-    def clients_list(self):
+    def clients_list(self, stream=False):
         return self._make_request('clients/list', data={
             'client_id': self.client_id,
             'client_secret': self.client_secret,
-        })
+        }, stream=stream)
 
     # Capture - clients/add
     def clients_add(self, description, features=None):
@@ -72,7 +517,7 @@ class JanrainClient(object):
             'description': description,
         }
         if features:
-            req['features'] = json.dumps(features)
+            req['features'] = codec.dumps(features)
         return self._make_request('clients/add', data=req, method='post')
 
     # Client - settings/set_multi
@@ -80,27 +525,196 @@ class JanrainClient(object):
         return self._make_request('settings/set_multi', method='post', data={
             'client_id': self.client_id,
             'client_secret': self.client_secret,
-            'items': json.dumps(items),
+            'items': codec.dumps(items),
             'for_client_id': for_client_id,
         })
 
     # TODO you know, the rest of the API.
 
-    def _make_request(self, path, method='get', data={}, headers={}):
+    def _make_request(self, path, method='get', data={}, headers={}, stream=False, idempotent=None,
+            priority=BATCH):
         """
-            Actually make a web request.
+            Actually make a web request, over the shared keep-alive session.
+
+            With ``stream`` the body is decoded as it arrives and a generator
+            of the records in its ``results`` array is returned instead.
+
+            Idempotent calls (GETs, unless told otherwise) are retried with
+            jittered exponential backoff on connection errors, timeouts and
+            5xx responses. Anything that still fails raises APIException.
+
+            Identical idempotent calls made while one is already in flight
+            wait for it and share its result, unless ``JANRAIN_SINGLE_FLIGHT``
+            is False. Writes are never shared.
+
+            With a rate_limiter, every attempt first waits its turn in the
+            ``priority`` lane.
         """
         method = method.lower()
         full_url = urlparse.urljoin(self.url, path)
 
         try:
-            hit_url = partial(getattr(requests, method), full_url)
+            hit_url = partial(getattr(get_session(), method), full_url)
         except AttributeError:
             raise ValueError("Invalid HTTP method %s" % method)
 
         kwargs = dict(headers=headers)
         key = 'params' if method == 'get' else 'data'
         kwargs[key] = data
+        kwargs['timeout'] = getattr(settings, 'JANRAIN_HTTP_TIMEOUTS', {}).get(path,
+            getattr(settings, 'JANRAIN_HTTP_TIMEOUT', 10))
+        if stream:
+            kwargs['stream'] = True
+
+        if idempotent is None:
+            idempotent = method == 'get'
+
+        if idempotent and not stream and getattr(settings, 'JANRAIN_SINGLE_FLIGHT', True):
+            # identical reads already on their way share that one call
+            flight = (full_url, method, repr(sorted(data.items())), headers.get('Authorization'))
+            return single_flight.do(flight, self._send, path, method, full_url, hit_url, kwargs,
+                idempotent, stream, priority)
+        return self._send(path, method, full_url, hit_url, kwargs, idempotent, stream, priority)
+
+    def _send(self, path, method, full_url, hit_url, kwargs, idempotent, stream, priority=BATCH):
+        """
+            Sends a request prepared by _make_request, with its retries, and
+            decodes the response.
+        """
+        retries = getattr(settings, 'JANRAIN_HTTP_RETRIES', 2) if idempotent else 0
+        backoff = getattr(settings, 'JANRAIN_HTTP_RETRY_BACKOFF', 0.1)
+        breaker = get_breaker(full_url)
+
+        measure = instrumentation.enabled()
+        attempt = 0
+        while True:
+            breaker.before_call(path)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(priority)
+            if measure:
+                started = time.time()
+            try:
+                response = hit_url(**kwargs)
+            except requests.RequestException as e:
+                if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                    error = dict(stat='error', error='connection_error', error_description=str(e))
+                else:
+                    error = dict(stat='error', error='request_error', error_description=str(e))
+                if measure:
+                    instrumentation.emit('api_call', path=path, method=method, status=None,
+                        duration=time.time() - started, size=None, attempt=attempt,
+                        error=error['error'])
+            except Exception:
+                # anything else still settles the breaker's trial call
+                breaker.failure()
+                raise
+            else:
+                if measure:
+                    instrumentation.emit('api_call', path=path, method=method,
+                        status=response.status_code, duration=time.time() - started,
+                        size=None if stream else len(response.content), attempt=attempt,
+                        error=None)
+                if response.status_code < 500:
+                    breaker.success()
+                    break
+                response.close()
+                error = dict(stat='error', error='server_error', code=response.status_code)
+
+            breaker.failure()
+            if attempt >= retries:
+                raise APIException(path, error)
+            time.sleep(random.uniform(0, backoff * 2 ** attempt))
+            attempt += 1
+
+        if stream:
+            return iter_results(response, path)
+
+        try:
+            return codec.loads(response.content)
+        except ValueError:
+            raise APIException(path, dict(stat='error', error='bad_response',
+                code=response.status_code))
+
+
+class AsyncJanrainClient(object):
+    """
+        Non-blocking counterpart of JanrainClient. Every method takes the same
+        arguments as on JanrainClient but runs the call on the shared worker
+        pool and returns immediately with an ``AsyncResult``; its
+        ``get(timeout=None)`` returns the response or raises the same
+        APIException the blocking call would have.
+
+        Calls go over the same pooled session as JanrainClient, so a handful
+        of workers can keep many Capture round trips in flight at once.
+    """
+    APIException = APIException
+
+    def __init__(self, client_id, client_secret, api_url, client=None):
+        self.client = client or JanrainClient(client_id, client_secret, api_url)
+
+    def auth_info(self, token):
+        return self._defer(self.client.auth_info, token)
+
+    def oauth_token(self, code, redirect_uri, grant_type='authorization_code'):
+        return self._defer(self.client.oauth_token, code, redirect_uri, grant_type)
+
+    def refresh_token(self, refresh_token):
+        return self._defer(self.client.refresh_token, refresh_token)
+
+    def entity(self, uuid=None, type_name=None, access_token=None):
+        return self._defer(self.client.entity, uuid, type_name, access_token)
+
+    def entity_update(self, uuid, type_name, update):
+        return self._defer(self.client.entity_update, uuid, type_name, update)
+
+    def clients_list(self):
+        return self._defer(self.client.clients_list)
+
+    def clients_add(self, description, features=None):
+        return self._defer(self.client.clients_add, description, features)
+
+    def settings_set_multi(self, for_client_id, items):
+        return self._defer(self.client.settings_set_multi, for_client_id, items)
+
+    def _defer(self, func, *args):
+        return get_pool().apply_async(func, args)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(client_id, client_secret, api_url):
+    """
+        Returns the process-wide JanrainClient for this api_url and set of
+        credentials, creating it on first use. Reusing clients keeps whatever
+        they hold (connections, caches) alive between requests.
+
+        :returns: JanrainClient
+    """
+    key = (api_url, client_id, client_secret)
+    try:
+        return _clients[key]
+    except KeyError:
+        with _clients_lock:
+            if key not in _clients:
+                _clients[key] = JanrainClient(client_id, client_secret, api_url,
+                    entity_cache=entity_cache_from_settings(),
+                    rate_limiter=rate_limiter_from_settings(client_id or api_url))
+            return _clients[key]
+
+def get_async_client(client_id, client_secret, api_url):
+    """
+        Returns an AsyncJanrainClient wrapping the registered JanrainClient
+        for this api_url and set of credentials.
+
+        :returns: AsyncJanrainClient
+    """
+    return AsyncJanrainClient(client_id, client_secret, api_url,
+        client=get_client(client_id, client_secret, api_url))
 
-        response = hit_url(**kwargs)
-        return json.loads(response.content)
+def clear_clients():
+    """
+        Forgets every registered client.
+    """
+    with _clients_lock:
+        _clients.clear()
@@ -1,15 +1,93 @@
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache as default_cache, get_cache
 from hashlib import sha1
 from base64 import urlsafe_b64encode as safe_encode
 
+_caches = {}
+
+# how long to remember the digest of a user's last synced profile
+PROFILE_DIGEST_TIMEOUT = 30 * 24 * 3600
+
+def user_cache():
+    """
+        The Django cache configured by ``JANRAIN_USER_CACHE`` (a dict with
+        ``BACKEND``, a ``CACHES`` alias, and ``TIMEOUT`` in seconds), or None
+        when user caching is off.
+    """
+    conf = getattr(settings, 'JANRAIN_USER_CACHE', None)
+    if not conf:
+        return None
+
+    alias = conf.get('BACKEND', 'default')
+    try:
+        return _caches[alias]
+    except KeyError:
+        return _caches.setdefault(alias, get_cache(alias))
+
+def user_cache_timeout():
+    return settings.JANRAIN_USER_CACHE.get('TIMEOUT', 300)
+
+def hashed_key(hashed):
+    return 'janrain:hashed:%s' % hashed
+
+def user_key(user_id):
+    return 'janrain:user:%s' % user_id
+
+def profile_key(user_id):
+    return 'janrain:profile:%s' % user_id
+
+def profile_digest(fields):
+    return sha1(repr(sorted(fields.items()))).hexdigest()
+
+def forget_user(sender, instance, **kwargs):
+    """
+        post_save/post_delete receiver for User that drops its cache entries.
+    """
+    cache = user_cache()
+    if cache is not None:
+        cache.delete_many([user_key(instance.pk), hashed_key(instance.username)])
+
 class JanrainUser(object):
     """
         This class acts as a quantum container for user data from either the
         Engage or Capture (entity) APIs. Needed properties resolve themselves
         based on the topology of the user_data passed to the constructor.
+
+        The canonical fields are pulled out of user_data in a single pass when
+        the object is built, and ``hashed`` is computed at most once.
     """
+    __slots__ = ('data', '_uuid', '_hashed', '_names', '_email', '_provider')
+
     def __init__(self, user_data):
         self.data = user_data
+        self._hashed = None
+
+        profile = user_data.get('profile')
+
+        self._uuid = user_data.get('uuid')
+        self._provider = 'capture'
+        if not self._uuid and profile is not None:
+            self._uuid = profile.get('identifier')
+            self._provider = 'engage'
+
+        given_name = user_data.get('givenName', '')
+        family_name = user_data.get('familyName', '')
+        display_name = user_data.get('displayName', '')
+        if not any([given_name, family_name, display_name]) and profile is not None:
+            # Engage: profile.name holds the parts, displayName sits beside it
+            name = profile.get('name') or {}
+            given_name = name.get('givenName', '')
+            family_name = name.get('familyName', '')
+            display_name = profile.get('displayName', '')
+        self._names = (given_name or display_name, family_name)
+
+        self._email = user_data.get('email')
+        if not self._email:
+            if profile is not None:
+                self._email = profile.get('verifiedEmail', '') or profile.get('email', '')
+            else:
+                self._email = ''
 
     def __getitem__(self, key):
         return self.data[key]
@@ -27,14 +105,19 @@ class JanrainUser(object):
 
         :returns: string
         """
-        uuid = self.data.get('uuid')
-        if not uuid:
-            try:
-                uuid = self.data['profile']['identifer']
-            except KeyError:
-                raise ValueError("Cannot uniquely identify user: %s" % self.data)
+        if not self._uuid:
+            raise ValueError("Cannot uniquely identify user: %s" % self.data)
+
+        return self._uuid
+
+    @property
+    def provider(self):
+        """
+        Which API the user data came from.
 
-        return uuid
+        :returns: 'capture' or 'engage'
+        """
+        return self._provider
 
     @property
     def hashed(self):
@@ -49,7 +132,10 @@ class JanrainUser(object):
         # 30 characters we url-safe base64 encode the sha1 of the identifier
         # returned from janrain and slice `=` from the end.
         # TODO this obviously won't work until user_data is canonicalized
-        return safe_encode(sha1(self.uuid).digest())[:-1]
+        if self._hashed is None:
+            self._hashed = safe_encode(sha1(self.uuid).digest())[:-1]
+
+        return self._hashed
 
     @property
     def names(self):
@@ -58,22 +144,7 @@ class JanrainUser(object):
 
         :returns: Tuple of (first_name, last_name). Either may be ''.
         """
-
-        given_name = self.data.get('givenName', '')
-        family_name = self.data.get('familyName', '')
-        display_name = self.data.get('displayName', '')
-
-        if not any([given_name, family_name, display_name]):
-            try:
-                names = self.data['profile']['names']
-            except KeyError:
-                return ('', '')
-
-            given_name = names.get('givenName', '')
-            family_name = names.get('familyName', '')
-            display_name = names.get('displayName', '')
-
-        return (given_name or display_name, family_name)
+        return self._names
 
     @property
     def email(self):
@@ -82,16 +153,7 @@ class JanrainUser(object):
 
         :returns: either an email address or ''
         """
-        email = self.data.get('email')
-
-        if not email:
-            try:
-                profile = self.data['profile']
-            except KeyError:
-                return ''
-            email = profile.get('verifiedEmail', '') or profile.get('email', '')
-
-        return email
+        return self._email
 
 class JanrainBackend(object):
 
@@ -112,18 +174,87 @@ class JanrainBackend(object):
 
         if not user:
             user = self.create_user(janrain_user)
+            if getattr(settings, 'JANRAIN_USE_IDENTITIES', False):
+                self.link_identity(user, janrain_user)
+            if getattr(settings, 'JANRAIN_SYNC_PROFILE', False):
+                self.remember_profile(user, self.profile_fields(janrain_user))
+        elif getattr(settings, 'JANRAIN_SYNC_PROFILE', False):
+            self.sync_user(user, janrain_user)
+
+        if janrain_user.provider == 'capture' and getattr(settings, 'JANRAIN_PROFILE_MIRROR', None):
+            self.mirror_entity(janrain_user)
 
         return user
 
+    def profile_fields(self, janrain_user):
+        """
+        The User fields kept in step with the Janrain profile when
+        ``JANRAIN_SYNC_PROFILE`` is on.
+
+        This is intended to be overridden.
+
+        :param janrain_user: JanrainUser
+        :returns: dict of User field name to value
+        """
+        fn, ln = janrain_user.names
+        return dict(first_name=fn, last_name=ln, email=janrain_user.email)
+
+    def sync_user(self, user, janrain_user):
+        """
+        Copies changed profile_fields onto user, writing only the columns
+        that differ. A digest of the last synced profile is cached so an
+        unchanged profile costs neither a comparison nor a write.
+
+        :param user: User
+        :param janrain_user: JanrainUser
+        :returns: list of changed field names
+        """
+        fields = self.profile_fields(janrain_user)
+        digest = profile_digest(fields)
+        cache = user_cache() or default_cache
+        key = profile_key(user.pk)
+        if cache.get(key) == digest:
+            return []
+
+        changed = dict((name, value) for name, value in fields.items()
+            if getattr(user, name) != value)
+        if changed:
+            # Django 1.4 has no save(update_fields=...)
+            User.objects.filter(pk=user.pk).update(**changed)
+            for name, value in changed.items():
+                setattr(user, name, value)
+            # update() sends no post_save
+            forget_user(User, user)
+
+        cache.set(key, digest, PROFILE_DIGEST_TIMEOUT)
+        return changed.keys()
+
+    def remember_profile(self, user, fields):
+        """
+        Records fields as user's last synced profile.
+        """
+        cache = user_cache() or default_cache
+        cache.set(profile_key(user.pk), profile_digest(fields), PROFILE_DIGEST_TIMEOUT)
+
     def get_user(self, user_id):
         """
             Must implement this. Deserializes a user id.
         """
+        cache = user_cache()
+        if cache is not None:
+            user = cache.get(user_key(user_id))
+            if user is not None:
+                return user
+
         try:
-            return User.objects.get(pk=user_id)
+            user = User.objects.get(pk=user_id)
         except User.DoesNotExist:
             return None
 
+        if cache is not None:
+            cache.set(user_key(user_id), user, user_cache_timeout())
+        return user
+
     def find_user(self, janrain_user):
         """
         Looks up a user in the User table that corresponds to the passed
@@ -134,17 +265,92 @@ class JanrainBackend(object):
         :param janrain_user: JanrainUser
         :returns: Either None or User
         """
+        if getattr(settings, 'JANRAIN_USE_IDENTITIES', False):
+            from janrain.models import JanrainIdentity
+            try:
+                return JanrainIdentity.objects.select_related('user').get(
+                    provider=janrain_user.provider, uuid=janrain_user.uuid).user
+            except JanrainIdentity.DoesNotExist:
+                # not linked yet; fall back to the username and link it
+                user = self.find_user_by_username(janrain_user)
+                if user is not None:
+                    self.link_identity(user, janrain_user)
+                return user
+
+        return self.find_user_by_username(janrain_user)
+
+    def find_user_by_username(self, janrain_user):
+        """
+        Looks up the User whose username is janrain_user's hash.
+
+        :param janrain_user: JanrainUser
+        :returns: Either None or User
+        """
+        hashed = janrain_user.hashed
+        cache = user_cache()
+        if cache is not None:
+            user_id = cache.get(hashed_key(hashed))
+            if user_id is not None:
+                user = self.get_user(user_id)
+                # the username may have changed since we cached its pk
+                if user is not None and user.username == hashed:
+                    return user
+
         try:
-            return User.objects.get(username=janrain_user.hashed)
+            user = User.objects.get(username=hashed)
         except User.DoesNotExist:
             return None
 
+        if cache is not None:
+            cache.set_many({
+                hashed_key(hashed): user.pk,
+                user_key(user.pk): user,
+            }, user_cache_timeout())
+        return user
+
+    def link_identity(self, user, janrain_user):
+        """
+        Records that janrain_user is one of user's identities.
+
+        :param user: User
+        :param janrain_user: JanrainUser
+        :returns: JanrainIdentity
+        """
+        from janrain.models import JanrainIdentity
+        identity, created = JanrainIdentity.objects.get_or_create(
+            provider=janrain_user.provider, uuid=janrain_user.uuid,
+            defaults=dict(user=user))
+        return identity
+
+    def mirror_entity(self, janrain_user):
+        """
+        Copies janrain_user's Capture entity into the profile mirror, unless
+        it hasn't changed since the last login.
+
+        :param janrain_user: JanrainUser
+        """
+        from janrain.mirror import profile_mirror_from_settings
+        profile_mirror_from_settings().store_changed(janrain_user.data)
+
     def create_user(self, janrain_user):
         """
         Creates a User based on janrain_user.
 
         This is intended to be overridden.
 
+        :param janrain_user: JanrainUser
+        :returns: User
+        """
+        u = self.build_user(janrain_user)
+        u.save()
+
+        return u
+
+    def build_user(self, janrain_user):
+        """
+        Builds, but does not save, a User based on janrain_user. Used by
+        create_user and by bulk imports.
+
         :param janrain_user: JanrainUser
         :returns: User
         """
@@ -162,6 +368,5 @@ class JanrainBackend(object):
         u.is_active = True
         u.is_staff = False
         u.is_superuser = False
-        u.save()
 
         return u
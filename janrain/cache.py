@@ -0,0 +1,140 @@
+import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError: # python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from django.conf import settings
+
+from janrain import codec, instrumentation
+
+class EntityCache(object):
+    """
+        Caches successful Capture ``entity`` responses by uuid and type_name.
+
+        By default entries live in a bounded, in-process LRU and expire after
+        ``ttl`` seconds. Pass the alias of one of Django's ``CACHES`` as
+        ``backend`` to share entries between processes and nodes instead; the
+        Django cache then takes care of expiry and eviction. Local entries are
+        kept serialized, so every hit is a fresh copy its caller may modify.
+    """
+    def __init__(self, ttl=60, max_size=1000, backend=None, key_prefix='janrain:entity'):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.key_prefix = key_prefix
+        # django.core.cache reads settings on import, janrain.api mustn't
+        from django.core.cache import get_cache
+        self.backend = get_cache(backend) if backend else None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, uuid, type_name):
+        return '%s:%s:%s' % (self.key_prefix, type_name, uuid)
+
+    def get(self, uuid, type_name):
+        """
+        :returns: the cached response, or None
+        """
+        key = self.key(uuid, type_name)
+        if self.backend is not None:
+            response = self.backend.get(key)
+        else:
+            cached = None
+            with self._lock:
+                try:
+                    expires, cached = self._entries.pop(key)
+                except KeyError:
+                    pass
+                else:
+                    if expires > time.time():
+                        # most recently used goes to the back of the line
+                        self._entries[key] = (expires, cached)
+                    else:
+                        cached = None
+            response = codec.loads(cached) if cached is not None else None
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if instrumentation.enabled():
+            instrumentation.emit('cache', cache='entity', hit=response is not None)
+        return response
+
+    def set(self, uuid, type_name, response):
+        key = self.key(uuid, type_name)
+        if self.backend is not None:
+            self.backend.set(key, response, self.ttl)
+            return
+
+        cached = codec.dumps(response)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, cached)
+            while len(self._entries) > self.max_size:
+                del self._entries[next(iter(self._entries))]
+
+    def update(self, uuid, type_name, update):
+        # updates are partial, so there's nothing whole to write through
+        self.invalidate(uuid, type_name)
+
+    def invalidate(self, uuid, type_name):
+        key = self.key(uuid, type_name)
+        if self.backend is not None:
+            self.backend.delete(key)
+        else:
+            with self._lock:
+                self._entries.pop(key, None)
+
+    def invalidate_many(self, uuids, type_name):
+        keys = [self.key(uuid, type_name) for uuid in uuids]
+        if self.backend is not None:
+            self.backend.delete_many(keys)
+        else:
+            with self._lock:
+                for key in keys:
+                    self._entries.pop(key, None)
+
+    def clear(self):
+        """
+            Drops every local entry and resets the counters. Entries held in a
+            Django cache backend are left to expire.
+        """
+        with self._lock:
+            self._entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        :returns: dict of hits, misses and (local) size
+        """
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries))
+
+def entity_cache_from_settings():
+    """
+        Builds an EntityCache from ``JANRAIN_ENTITY_CACHE``, a dict with any
+        of ``TTL``, ``MAX_SIZE``, ``BACKEND`` and ``KEY_PREFIX``. Caching is off
+        when the setting is missing or empty.
+
+        With ``JANRAIN_PROFILE_MIRROR`` on, the mirror is used instead.
+
+        :returns: EntityCache, ProfileMirror or None
+    """
+    if getattr(settings, 'JANRAIN_PROFILE_MIRROR', None):
+        from janrain.mirror import profile_mirror_from_settings
+        return profile_mirror_from_settings()
+
+    conf = getattr(settings, 'JANRAIN_ENTITY_CACHE', None)
+    if not conf:
+        return None
+    return EntityCache(
+        ttl=conf.get('TTL', 60),
+        max_size=conf.get('MAX_SIZE', 1000),
+        backend=conf.get('BACKEND'),
+        key_prefix=conf.get('KEY_PREFIX', 'janrain:entity'),
+    )
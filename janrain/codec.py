@@ -0,0 +1,94 @@
+"""
+The JSON codec used for Janrain request payloads and responses.
+
+Capture entities are large documents, so decoding them is a noticeable part
+of a login. ``JANRAIN_JSON_CODEC`` names a faster drop-in, as the dotted path
+of a module or object with ``loads`` and ``dumps`` (e.g. 'ujson' or
+'simplejson'), or a list of them to try in order. The first one that imports
+is used; without any, or with none importable, the stdlib ``json`` is. The
+codec is chosen on first use.
+
+``loads`` takes the response body as bytes, straight from
+``response.content``, so no decoded copy of the text is made first.
+"""
+import json
+import logging
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+logger = logging.getLogger(__name__)
+
+class StdlibCodec(object):
+    name = 'json'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+class ModuleCodec(object):
+    """
+        Wraps anything with ``loads`` and ``dumps``, like the ujson module.
+    """
+    def __init__(self, name, module):
+        self.name = name
+        self.loads = module.loads
+        self.dumps = module.dumps
+
+def import_codec(path):
+    """
+    :returns: ModuleCodec for the module or object at dotted path
+    :raises: ImportError if it can't be imported, or has no ``loads`` and
+        ``dumps`` (cjson, for one, has ``encode`` and ``decode`` instead)
+    """
+    try:
+        module = import_module(path)
+    except ImportError:
+        if '.' not in path:
+            raise
+        module_path, attr = path.rsplit('.', 1)
+        try:
+            module = getattr(import_module(module_path), attr)
+        except AttributeError:
+            raise ImportError('No codec %s' % path)
+    if not (hasattr(module, 'loads') and hasattr(module, 'dumps')):
+        raise ImportError('%s has no loads and dumps' % path)
+    return ModuleCodec(path, module)
+
+active = None
+
+def load_codec():
+    """
+        Switches to the first importable codec named in
+        ``JANRAIN_JSON_CODEC``, or to the stdlib's.
+    """
+    global active
+    paths = getattr(settings, 'JANRAIN_JSON_CODEC', None) or ()
+    if isinstance(paths, basestring):
+        paths = (paths,)
+    for path in paths:
+        try:
+            active = import_codec(path)
+            return
+        except ImportError as e:
+            logger.warning('JSON codec %s is unusable: %s', path, e)
+    active = StdlibCodec()
+
+def get_codec():
+    """
+    :returns: the active codec, choosing it on first call
+    """
+    if active is None:
+        load_codec()
+    return active
+
+def loads(data):
+    """
+    :param data: JSON bytes
+    """
+    return get_codec().loads(data)
+
+def dumps(obj):
+    return get_codec().dumps(obj)
@@ -0,0 +1,212 @@
+"""
+Measurements of Janrain calls, handed to pluggable sinks.
+
+Events are emitted with a name and a dict of fields:
+
+``api_call``
+    one HTTP round trip: path, method, status, duration (seconds), size
+    (bytes, None when streamed), attempt (0 for the first try) and error
+``cache``
+    an entity cache lookup: cache, hit
+``login``
+    authenticate + login in a view: view, duration
+``rate_limit``
+    a call let through the rate limiter: priority, wait (seconds) and queued
+    (callers already waiting)
+
+A sink is any callable taking (name, data). Configure them with
+``JANRAIN_INSTRUMENTATION_SINKS``, a list of dotted paths to sink classes
+(instantiated with no arguments) or sink objects, e.g.::
+
+    JANRAIN_INSTRUMENTATION_SINKS = (
+        'janrain.instrumentation.StatsdSink',
+        'janrain.instrumentation.histogram',
+    )
+
+Sinks are loaded on first use. With none configured, instrumented code skips
+measuring altogether.
+"""
+import bisect
+import logging
+import socket
+import threading
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from janrain.signals import instrumented
+
+logger = logging.getLogger(__name__)
+
+sinks = []
+_loaded = False
+
+def enabled():
+    """
+    :returns: True if any sink is configured, loading them on first call
+    """
+    if not _loaded:
+        load_sinks()
+    return bool(sinks)
+
+def emit(name, **data):
+    for sink in sinks:
+        try:
+            sink(name, data)
+        except Exception:
+            # metrics must never take down a login
+            logger.exception('Instrumentation sink %r failed on %s', sink, name)
+
+def load_sinks():
+    """
+        Replaces the active sinks with those named in
+        ``JANRAIN_INSTRUMENTATION_SINKS``.
+    """
+    loaded = []
+    for path in getattr(settings, 'JANRAIN_INSTRUMENTATION_SINKS', ()):
+        module, attr = path.rsplit('.', 1)
+        sink = getattr(import_module(module), attr)
+        if isinstance(sink, type):
+            sink = sink()
+        loaded.append(sink)
+    # swap in place so modules holding a reference see the change
+    sinks[:] = loaded
+    global _loaded
+    _loaded = True
+
+class SignalSink(object):
+    """
+        Re-sends every event as the ``janrain.signals.instrumented`` signal.
+        A failing receiver is logged and doesn't stop the others.
+    """
+    def __call__(self, name, data):
+        results = instrumented.send_robust(sender=self.__class__, name=name, data=data)
+        for receiver, result in results:
+            if isinstance(result, Exception):
+                logger.error('instrumented receiver %r failed on %s: %r', receiver, name, result)
+
+def metric_name(path):
+    return path.replace('/', '_').replace('.', '_')
+
+class StatsdSink(object):
+    """
+        Sends events to statsd over UDP. Configured by ``JANRAIN_STATSD_HOST``
+        (default 'localhost'), ``JANRAIN_STATSD_PORT`` (8125) and
+        ``JANRAIN_STATSD_PREFIX`` ('janrain').
+    """
+    def __init__(self, host=None, port=None, prefix=None):
+        self.addr = (
+            host or getattr(settings, 'JANRAIN_STATSD_HOST', 'localhost'),
+            port or getattr(settings, 'JANRAIN_STATSD_PORT', 8125),
+        )
+        self.prefix = prefix or getattr(settings, 'JANRAIN_STATSD_PREFIX', 'janrain')
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, name, data):
+        if name == 'api_call':
+            stat = '%s.api.%s' % (self.prefix, metric_name(data['path']))
+            lines = [
+                '%s.time:%d|ms' % (stat, data['duration'] * 1000),
+                '%s.status.%s:1|c' % (stat, data['status'] or data['error']),
+            ]
+            if data['size'] is not None:
+                lines.append('%s.size:%d|h' % (stat, data['size']))
+            if data['attempt']:
+                lines.append('%s.retries:1|c' % stat)
+        elif name == 'cache':
+            lines = ['%s.cache.%s.%s:1|c' % (self.prefix, data['cache'], 'hit' if data['hit'] else 'miss')]
+        elif name == 'login':
+            lines = ['%s.login.%s.time:%d|ms' % (self.prefix, data['view'], data['duration'] * 1000)]
+        elif name == 'rate_limit':
+            stat = '%s.rate_limit.%s' % (self.prefix, data['priority'])
+            lines = [
+                '%s.wait:%d|ms' % (stat, data['wait'] * 1000),
+                '%s.queued:%d|g' % (stat, data['queued']),
+            ]
+        else:
+            return
+
+        try:
+            self.sock.sendto('\n'.join(lines), self.addr)
+        except socket.error:
+            # metrics must never take down a login
+            pass
+
+class Histogram(object):
+    """
+        In-process sink keeping latency histograms (fixed buckets, in
+        milliseconds) and counters, for querying from a shell or a status
+        page. Keys look like 'api_call:entity', 'login:oauth_redirect',
+        'rate_limit:batch' and, for counters, 'api_call:entity:status:200' or
+        'cache:entity:hit'.
+    """
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+
+    def __call__(self, name, data):
+        if name == 'api_call':
+            key = 'api_call:%s' % data['path']
+            self.observe(key, data['duration'])
+            self.count('%s:status:%s' % (key, data['status'] or data['error']))
+            if data['attempt']:
+                self.count('%s:retries' % key)
+        elif name == 'cache':
+            self.count('cache:%s:%s' % (data['cache'], 'hit' if data['hit'] else 'miss'))
+        elif name == 'login':
+            self.observe('login:%s' % data['view'], data['duration'])
+        elif name == 'rate_limit':
+            self.observe('rate_limit:%s' % data['priority'], data['wait'])
+
+    def observe(self, key, seconds):
+        ms = seconds * 1000
+        with self._lock:
+            try:
+                counts = self.timings[key]
+            except KeyError:
+                counts = self.timings[key] = [0] * (len(self.BUCKETS) + 1)
+            counts[bisect.bisect_left(self.BUCKETS, ms)] += 1
+
+    def count(self, key):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def percentile(self, key, p):
+        """
+        :returns: upper bound, in milliseconds, of the bucket holding the
+            p-th percentile of key's timings; None if there are none, or if
+            it's beyond the largest bucket
+        """
+        counts = self.timings.get(key)
+        if not counts:
+            return None
+        rank = sum(counts) * p / 100.0
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (None,), counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+    def summary(self):
+        """
+        :returns: dict of key to dict(count, p50, p95, p99) for timings,
+            plus a 'counters' entry
+        """
+        result = dict(counters=dict(self.counters))
+        for key, counts in self.timings.items():
+            result[key] = dict(
+                count=sum(counts),
+                p50=self.percentile(key, 50),
+                p95=self.percentile(key, 95),
+                p99=self.percentile(key, 99),
+            )
+        return result
+
+histogram = Histogram()
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from janrain.writebehind import get_queue
+
+class Command(BaseCommand):
+    help = 'Sends entity updates waiting in the write-behind queue to Capture.'
+
+    def handle(self, *args, **options):
+        queue = get_queue()
+        sent, failed = queue.flush()
+        self.stdout.write('%d sent, %d failed, %d pending\n' % (sent, failed, queue.pending()))
@@ -0,0 +1,55 @@
+from itertools import islice
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from janrain.provisioning import USER_ATTRIBUTES, Checkpoint, import_users, read_jsonl
+from janrain.views import capture_client
+
+class Command(BaseCommand):
+    args = '[entities.jsonl]'
+    help = ('Creates local Users for Janrain accounts, read from a JSON-lines '
+        'file or, without one, from a Capture entity.find query.')
+    option_list = BaseCommand.option_list + (
+        make_option('--type-name', default='user',
+            help='Capture entity type to query. Default: user'),
+        make_option('--filter', default=None,
+            help='Capture entity.find filter expression.'),
+        make_option('--page-size', type='int', default=100,
+            help='Records per Capture page. Default: 100'),
+        make_option('--chunk-size', type='int', default=500,
+            help='Records looked up and created per database round trip. Default: 500'),
+        make_option('--checkpoint', default=None,
+            help='File recording progress; an existing one is resumed from.'),
+        make_option('--link-only', action='store_true', default=False,
+            help='Create no Users; only link existing ones to their JanrainIdentity.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Give at most one JSON-lines file.')
+
+        checkpoint = Checkpoint(options['checkpoint']) if options['checkpoint'] else None
+        start = checkpoint.load() if checkpoint else 0
+        if start:
+            self.stdout.write('Resuming after %d records\n' % start)
+
+        if args:
+            records = islice(read_jsonl(args[0]), start, None)
+        else:
+            # the profile mirror keeps whole entities
+            mirror = getattr(settings, 'JANRAIN_PROFILE_MIRROR', None)
+            records = capture_client().iter_entities(options['type_name'],
+                filter=options['filter'], attributes=None if mirror else USER_ATTRIBUTES,
+                page_size=options['page_size'], first_result=start)
+
+        stats = import_users(records, chunk_size=options['chunk_size'],
+            start=start, checkpoint=checkpoint, progress=self.report,
+            link_only=options['link_only'], type_name=options['type_name'])
+        self.report(stats)
+
+    def report(self, stats):
+        self.stdout.write('%(processed)d processed, %(created)d created, '
+            '%(existing)d existing, %(linked)d linked, %(mirrored)d mirrored, '
+            '%(invalid)d invalid (%(rate).0f/s)\n' % stats)
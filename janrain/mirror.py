@@ -0,0 +1,210 @@
+"""
+A local mirror of Capture entities, so profile reads can skip the network.
+
+    from janrain.mirror import profile_mirror_from_settings
+    mirror = profile_mirror_from_settings()
+    mirror.find_by_email('nate@example.com')
+
+Entities are kept in the MirroredEntity table. They are written by
+JanrainBackend.authenticate, by bulk imports and by JanrainClient, which uses
+the mirror in place of its entity cache; entity_update merges into the
+mirrored copy. Reads are served while the copy is younger than ``max_age``
+seconds. Entities are serialized with ``janrain.codec``. Configure with
+``JANRAIN_PROFILE_MIRROR``; see the README.
+"""
+from datetime import datetime, timedelta
+from hashlib import sha1
+
+from django.conf import settings
+from django.core.cache import cache as default_cache
+from django.db import transaction
+from django.utils import timezone
+
+from janrain import codec, instrumentation
+from janrain.backends import JanrainUser, user_cache
+from janrain.models import MirroredEntity
+from janrain.writebehind import create_unless_exists, merge
+
+def epoch():
+    if settings.USE_TZ:
+        return datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return datetime(1970, 1, 1)
+
+class ProfileMirror(object):
+    """
+        Keeps Capture entities in the database, keyed by type_name and uuid.
+        Has the same get/set/update/invalidate interface as EntityCache, so
+        JanrainClient can read through it.
+    """
+    def __init__(self, max_age=300, type_name='user'):
+        self.max_age = max_age
+        # the entity type written at login and read by find_by_email
+        self.type_name = type_name
+        self.hits = 0
+        self.misses = 0
+
+    def digest_key(self, type_name, uuid):
+        return 'janrain:mirrored:%s:%s' % (type_name, uuid)
+
+    def fields(self, entity):
+        """
+        The indexed columns copied out of an entity.
+
+        :returns: dict of email and name
+        """
+        janrain_user = JanrainUser(entity)
+        return dict(
+            email=janrain_user.email.lower()[:254],
+            name=u' '.join(name for name in janrain_user.names if name)[:255],
+        )
+
+    def get(self, uuid, type_name):
+        """
+        :returns: the mirrored entity as an ``entity`` response, or None if
+            it isn't mirrored or is older than max_age
+        """
+        oldest = timezone.now() - timedelta(seconds=self.max_age)
+        data = MirroredEntity.objects.filter(type_name=type_name, uuid=uuid,
+            synced_at__gte=oldest).values_list('data', flat=True)[:1]
+        response = dict(stat='ok', result=codec.loads(data[0])) if data else None
+
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if instrumentation.enabled():
+            instrumentation.emit('cache', cache='mirror', hit=response is not None)
+        return response
+
+    def set(self, uuid, type_name, response):
+        self.store(response['result'], type_name)
+
+    def store(self, entity, type_name=None):
+        """
+        Writes a whole entity to the mirror and marks it fresh, in the
+        caller's transaction.
+
+        :param entity: Capture entity dict, including its uuid
+        :param type_name: defaults to the mirror's type_name
+        """
+        self._write(entity, type_name or self.type_name, codec.dumps(entity))
+
+    def store_changed(self, entity, type_name=None):
+        """
+        Stores entity unless it is unchanged since this method last stored
+        it. A digest of what was stored is cached (in ``JANRAIN_USER_CACHE``,
+        or the default cache) for half of max_age, so the copy skipped is
+        always still fresh.
+
+        :returns: True if the entity was written
+        """
+        type_name = type_name or self.type_name
+        data = codec.dumps(entity)
+        digest = sha1(data).hexdigest()
+        cache = user_cache() or default_cache
+        key = self.digest_key(type_name, entity['uuid'])
+        if cache.get(key) == digest:
+            return False
+        self._write(entity, type_name, data)
+        if self.max_age // 2:
+            cache.set(key, digest, self.max_age // 2)
+        return True
+
+    def _write(self, entity, type_name, data):
+        values = dict(self.fields(entity), data=data, synced_at=timezone.now())
+        rows = MirroredEntity.objects.filter(type_name=type_name, uuid=entity['uuid'])
+        # a concurrent login may create the row between update and create
+        while not rows.update(**values):
+            if create_unless_exists(MirroredEntity, type_name=type_name, uuid=entity['uuid'], **values):
+                return
+
+    def store_many(self, entities, type_name=None):
+        """
+        Writes a batch of whole entities, with one query for the ones already
+        mirrored and one bulk_create for the rest.
+
+        :param entities: list of Capture entity dicts
+        :returns: number of entities written
+        """
+        type_name = type_name or self.type_name
+        now = timezone.now()
+        entities = dict((entity['uuid'], entity) for entity in entities if entity.get('uuid'))
+        with transaction.commit_on_success():
+            existing = set(MirroredEntity.objects.filter(type_name=type_name,
+                uuid__in=entities.keys()).values_list('uuid', flat=True))
+            for uuid in existing:
+                entity = entities[uuid]
+                MirroredEntity.objects.filter(type_name=type_name, uuid=uuid).update(
+                    data=codec.dumps(entity), synced_at=now, **self.fields(entity))
+            MirroredEntity.objects.bulk_create([
+                MirroredEntity(type_name=type_name, uuid=uuid, data=codec.dumps(entity),
+                    synced_at=now, **self.fields(entity))
+                for uuid, entity in entities.iteritems() if uuid not in existing
+            ])
+        return len(entities)
+
+    def update(self, uuid, type_name, update):
+        """
+        Merges a successful entity_update into the mirrored copy, if there is
+        one. Its freshness is left alone: the rest of the entity is no newer.
+        """
+        while True:
+            try:
+                row = MirroredEntity.objects.get(type_name=type_name, uuid=uuid)
+            except MirroredEntity.DoesNotExist:
+                return
+            entity = merge(codec.loads(row.data), update)
+            # only if nobody else wrote it since
+            if MirroredEntity.objects.filter(pk=row.pk, data=row.data).update(
+                    data=codec.dumps(entity), **self.fields(entity)):
+                return
+
+    def invalidate(self, uuid, type_name):
+        self.invalidate_many([uuid], type_name)
+
+    def invalidate_many(self, uuids, type_name):
+        """
+        Marks entities stale, so the next ``get`` fetches them again. The
+        rows stay, and so does their place in the email and name indexes.
+        """
+        uuids = list(uuids)
+        MirroredEntity.objects.filter(type_name=type_name, uuid__in=uuids).update(
+            synced_at=epoch())
+        # or store_changed would skip the next login's fresh copy
+        (user_cache() or default_cache).delete_many(
+            [self.digest_key(type_name, uuid) for uuid in uuids])
+
+    def find_by_email(self, email, type_name=None):
+        """
+        Looks entities up by email on the index, however old their copies.
+
+        :returns: list of entity dicts
+        """
+        data = MirroredEntity.objects.filter(type_name=type_name or self.type_name,
+            email=email.lower()).values_list('data', flat=True)
+        return [codec.loads(entity) for entity in data]
+
+    def clear(self):
+        """
+            Resets the counters. Mirrored entities are kept.
+        """
+        self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        :returns: dict of hits, misses and size
+        """
+        return dict(hits=self.hits, misses=self.misses, size=MirroredEntity.objects.count())
+
+def profile_mirror_from_settings():
+    """
+        Builds a ProfileMirror from ``JANRAIN_PROFILE_MIRROR``, a dict with
+        optional ``MAX_AGE`` and ``TYPE_NAME``. The mirror is off when the setting is missing or
+        empty.
+
+        :returns: ProfileMirror or None
+    """
+    conf = getattr(settings, 'JANRAIN_PROFILE_MIRROR', None)
+    if not conf:
+        return None
+    return ProfileMirror(max_age=conf.get('MAX_AGE', 300), type_name=conf.get('TYPE_NAME', 'user'))
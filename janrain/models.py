@@ -1 +1,76 @@
-""" django, have you always been alone? """
+from django.contrib.auth.models import User
+from django.db import models
+from django.db.models.signals import post_save, post_delete
+
+from janrain.backends import forget_user
+from janrain.signals import entity_changed
+from janrain.webhooks import invalidate_entities
+
+post_save.connect(forget_user, sender=User, dispatch_uid='janrain.forget_user')
+post_delete.connect(forget_user, sender=User, dispatch_uid='janrain.forget_user')
+entity_changed.connect(invalidate_entities, dispatch_uid='janrain.invalidate_entities')
+
+class JanrainIdentity(models.Model):
+    """
+        Links a Janrain account, by provider and uuid, to a User. A User may
+        have several. Used by JanrainBackend when ``JANRAIN_USE_IDENTITIES``
+        is on.
+    """
+    PROVIDERS = (
+        ('capture', 'Capture'),
+        ('engage', 'Engage'),
+    )
+
+    provider = models.CharField(max_length=20, choices=PROVIDERS)
+    uuid = models.CharField(max_length=255)
+    user = models.ForeignKey(User, related_name='janrain_identities')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('provider', 'uuid'),)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.provider, self.uuid)
+
+class PendingEntityUpdate(models.Model):
+    """
+        An entity_update waiting to be sent to Capture by the write-behind
+        queue's database backend. Later updates to the same entity are merged
+        into ``value``. It is deleted once Capture has it.
+    """
+    type_name = models.CharField(max_length=100)
+    uuid = models.CharField(max_length=100)
+    value = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # set while a flush is sending it; see writebehind.DatabaseBackend
+    claim = models.CharField(max_length=32, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (('type_name', 'uuid'),)
+        ordering = ('created',)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.type_name, self.uuid)
+
+class MirroredEntity(models.Model):
+    """
+        A local copy of a Capture entity, kept by janrain.mirror.ProfileMirror
+        when ``JANRAIN_PROFILE_MIRROR`` is on. ``data`` is the entity as
+        compact JSON; ``email`` (lower-cased) and ``name`` are copied out of
+        it so they can be searched on an index.
+    """
+    type_name = models.CharField(max_length=100)
+    uuid = models.CharField(max_length=255)
+    data = models.TextField()
+    email = models.CharField(max_length=254, blank=True, db_index=True)
+    name = models.CharField(max_length=255, blank=True, db_index=True)
+    synced_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = (('type_name', 'uuid'),)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.type_name, self.uuid)
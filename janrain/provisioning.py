@@ -0,0 +1,145 @@
+"""
+Bulk creation of local Users for existing Janrain accounts.
+
+    from janrain.provisioning import import_users, read_jsonl
+    stats = import_users(read_jsonl('entities.jsonl'))
+"""
+from itertools import islice
+import json
+import os
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from janrain.backends import JanrainBackend, JanrainUser
+from janrain.mirror import profile_mirror_from_settings
+from janrain.models import JanrainIdentity
+
+# everything JanrainUser looks at in a Capture entity
+USER_ATTRIBUTES = ['uuid', 'givenName', 'familyName', 'displayName', 'email']
+
+def read_jsonl(path):
+    """
+    Streams records from a file holding one JSON object per line.
+
+    :param path: file name
+    :returns: generator of dicts
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+class Checkpoint(object):
+    """
+        Remembers how many records an import has worked through, so that an
+        interrupted import can pick up where it left off.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0)
+        except IOError:
+            return 0
+
+    def save(self, offset):
+        # write then rename so a crash never leaves a half-written offset
+        tmp = '%s.tmp' % self.path
+        with open(tmp, 'w') as f:
+            f.write('%d\n' % offset)
+        os.rename(tmp, self.path)
+
+def link_identities(janrain_users):
+    """
+    Creates the missing JanrainIdentity rows for the JanrainUsers whose User
+    exists under their hashed username, with one query for the Users, one
+    for existing identities and one bulk_create.
+
+    :param janrain_users: dict of hashed username to JanrainUser
+    :returns: number of identities created
+    """
+    user_ids = dict(User.objects.filter(username__in=janrain_users.keys())
+        .values_list('username', 'pk'))
+    existing = set(JanrainIdentity.objects
+        .filter(uuid__in=[janrain_user.uuid for janrain_user in janrain_users.values()])
+        .values_list('provider', 'uuid'))
+    identities = [
+        JanrainIdentity(provider=janrain_user.provider, uuid=janrain_user.uuid, user_id=user_ids[hashed])
+        for hashed, janrain_user in janrain_users.iteritems()
+        if hashed in user_ids and (janrain_user.provider, janrain_user.uuid) not in existing
+    ]
+    JanrainIdentity.objects.bulk_create(identities)
+    return len(identities)
+
+def import_users(records, backend=None, chunk_size=500, start=0, checkpoint=None, progress=None, link_only=False,
+        type_name=None):
+    """
+    Creates a User for every record that doesn't have one yet.
+
+    Records are mapped through JanrainUser and looked up ``chunk_size`` at a
+    time with a single ``username__in`` query; the missing Users are built
+    with ``backend.build_user`` and saved with one ``bulk_create`` per chunk.
+    When ``JANRAIN_USE_IDENTITIES`` is on, the records' JanrainIdentity rows
+    are created too, and when ``JANRAIN_PROFILE_MIRROR`` is on the Capture
+    records are written to the profile mirror.
+
+    :param records: iterable of Engage or Capture user dicts
+    :param backend: JanrainBackend (or subclass) used to build Users
+    :param start: offset of the first record, as tracked by ``checkpoint``
+    :param checkpoint: optional Checkpoint, saved after every chunk
+    :param progress: optional callable, passed the stats dict after every chunk
+    :param link_only: create no Users, only the identities of existing ones;
+        this backfills JanrainIdentity for Users created before it existed
+    :param type_name: Capture entity type of the records, for the mirror;
+        defaults to its ``TYPE_NAME``
+    :returns: dict of processed, created, existing, linked, mirrored,
+        invalid, elapsed and rate
+    """
+    backend = backend or JanrainBackend()
+    records = iter(records)
+    stats = dict(processed=0, created=0, existing=0, linked=0, mirrored=0, invalid=0, elapsed=0.0, rate=0.0)
+    link = link_only or getattr(settings, 'JANRAIN_USE_IDENTITIES', False)
+    mirror = profile_mirror_from_settings()
+    started = time.time()
+
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+
+        users = {}
+        for record in chunk:
+            janrain_user = JanrainUser(record)
+            try:
+                users.setdefault(janrain_user.hashed, janrain_user)
+            except ValueError:
+                stats['invalid'] += 1
+
+        existing = set(User.objects.filter(username__in=users.keys())
+            .values_list('username', flat=True))
+        if not link_only:
+            User.objects.bulk_create([backend.build_user(janrain_user)
+                for hashed, janrain_user in users.iteritems() if hashed not in existing])
+            stats['created'] += len(users) - len(existing)
+        if link:
+            stats['linked'] += link_identities(users)
+        if mirror is not None:
+            stats['mirrored'] += mirror.store_many([janrain_user.data
+                for janrain_user in users.itervalues() if janrain_user.provider == 'capture'], type_name)
+
+        stats['processed'] += len(chunk)
+        stats['existing'] += len(existing)
+        stats['elapsed'] = time.time() - started
+        stats['rate'] = stats['processed'] / stats['elapsed'] if stats['elapsed'] else 0.0
+
+        if checkpoint is not None:
+            checkpoint.save(start + stats['processed'])
+        if progress is not None:
+            progress(stats)
+
+    return stats
@@ -0,0 +1,192 @@
+"""
+Client-side rate limiting of Janrain calls, with a lane for interactive calls
+that always goes ahead of batch work.
+
+    limiter = RateLimiter(TokenBucket(rate=10, burst=20))
+    limiter.acquire(INTERACTIVE)
+
+JanrainClient takes a limiter from ``JANRAIN_RATE_LIMIT``; see the README.
+Calls made on a user's behalf during login (``auth_info``, ``oauth_token``,
+``refresh_token`` and ``entity`` with an access token) are INTERACTIVE,
+everything else is BATCH.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from janrain import instrumentation
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+class TokenBucket(object):
+    """
+        Allows ``rate`` calls a second on average and bursts of up to
+        ``burst``, in this process.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, reserve=0):
+        """
+        Takes a token if one is free beyond the ``reserve`` held back.
+
+        :returns: 0 if a token was taken, else seconds until one may be
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1 + reserve:
+                self.tokens -= 1
+                return 0
+            return (1 + reserve - self.tokens) / self.rate
+
+class CacheTokenBucket(object):
+    """
+        Allows ``rate`` calls in each one-second window across every process
+        sharing the Django cache ``alias``, counted with ``cache.incr``. The
+        cache should be one that all processes share, like memcached. While
+        the cache fails, calls are limited by a TokenBucket in this process.
+    """
+    def __init__(self, rate, alias='default', key='janrain:ratelimit'):
+        self.rate = int(rate)
+        # django.core.cache reads settings on import, janrain.api mustn't
+        from django.core.cache import get_cache
+        self.cache = get_cache(alias)
+        self.key = key
+        self.fallback = TokenBucket(rate)
+
+    def take(self, reserve=0):
+        """
+        :returns: 0 if a call was counted, else seconds until the next window
+        """
+        try:
+            return self._take(reserve)
+        except Exception:
+            logger.warning('Rate limit cache failed, limiting in this process', exc_info=True)
+            return self.fallback.take(reserve)
+
+    def _take(self, reserve):
+        now = time.time()
+        key = '%s:%d' % (self.key, now)
+        self.cache.add(key, 0, 5)
+        try:
+            count = self.cache.incr(key)
+        except ValueError:
+            # expired between add and incr
+            self.cache.add(key, 1, 5)
+            count = 1
+        if count <= self.rate - reserve:
+            return 0
+        # not taken, so not counted
+        try:
+            self.cache.decr(key)
+        except ValueError:
+            # evicted, so nothing left to uncount
+            pass
+        return int(now) + 1 - now
+
+class RateLimiter(object):
+    """
+        Hands out a bucket's calls by priority: BATCH callers wait while any
+        INTERACTIVE caller is waiting, and may only use the calls beyond
+        ``reserve``, which are held back for INTERACTIVE callers in every
+        process sharing the bucket.
+    """
+    def __init__(self, bucket, reserve=0):
+        self.bucket = bucket
+        self.reserve = reserve
+        self.cond = threading.Condition()
+        self.waiting = {INTERACTIVE: 0, BATCH: 0}
+        self.acquired = {INTERACTIVE: 0, BATCH: 0}
+        self.waited = {INTERACTIVE: 0.0, BATCH: 0.0}
+        self.max_wait = {INTERACTIVE: 0.0, BATCH: 0.0}
+
+    def acquire(self, priority=BATCH):
+        """
+        Blocks until a call may be made.
+
+        :returns: seconds waited
+        """
+        started = time.time()
+        reserve = self.reserve if priority == BATCH else 0
+        with self.cond:
+            queued = self.waiting[INTERACTIVE] + self.waiting[BATCH]
+            self.waiting[priority] += 1
+        try:
+            while True:
+                with self.cond:
+                    while priority == BATCH and self.waiting[INTERACTIVE]:
+                        self.cond.wait()
+                # unlocked, as the bucket may be a round trip to the cache
+                wait = self.bucket.take(reserve)
+                if not wait:
+                    break
+                with self.cond:
+                    self.cond.wait(wait)
+        finally:
+            with self.cond:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+
+        waited = time.time() - started
+        with self.cond:
+            self.acquired[priority] += 1
+            self.waited[priority] += waited
+            self.max_wait[priority] = max(self.max_wait[priority], waited)
+
+        if instrumentation.enabled():
+            instrumentation.emit('rate_limit', priority=priority, wait=waited, queued=queued)
+        return waited
+
+    def stats(self):
+        """
+        :returns: dict of priority to dict of waiting (callers queued now),
+            acquired, average_wait and max_wait (seconds)
+        """
+        with self.cond:
+            return dict((priority, dict(
+                waiting=self.waiting[priority],
+                acquired=self.acquired[priority],
+                average_wait=self.waited[priority] / self.acquired[priority] if self.acquired[priority] else 0.0,
+                max_wait=self.max_wait[priority],
+            )) for priority in (INTERACTIVE, BATCH))
+
+def rate_limiter_from_settings(name):
+    """
+        Builds a RateLimiter from ``JANRAIN_RATE_LIMIT``, a dict with
+        ``RATE`` (calls a second) and any of ``BURST``, ``RESERVE`` and
+        ``CACHE`` (a ``CACHES`` alias to share the limit between processes).
+        Limiting is off when the setting is missing or empty.
+
+        :raises: ImproperlyConfigured if RESERVE leaves batch calls nothing
+
+        :param name: distinguishes the limits of different credentials
+        :returns: RateLimiter or None
+    """
+    conf = getattr(settings, 'JANRAIN_RATE_LIMIT', None)
+    if not conf:
+        return None
+    reserve = conf.get('RESERVE', 0)
+    if conf.get('CACHE'):
+        bucket = CacheTokenBucket(conf['RATE'], conf['CACHE'], key='janrain:ratelimit:%s' % name)
+        limit, limit_name = bucket.rate, 'RATE'
+    else:
+        bucket = TokenBucket(conf['RATE'], conf.get('BURST'))
+        limit, limit_name = bucket.burst, 'BURST'
+    # batch calls need a call beyond the reserve, and there are never more
+    # than the limit
+    if reserve > limit - 1:
+        raise ImproperlyConfigured('JANRAIN_RATE_LIMIT RESERVE (%s) must be at most %s - 1 (%s), '
+            'or batch calls could never be made' % (reserve, limit_name, limit - 1))
+    return RateLimiter(bucket, reserve=reserve)
@@ -0,0 +1,10 @@
+from django.dispatch import Signal
+
+# Sent by janrain.instrumentation.SignalSink for every measurement; ``name``
+# is the kind of event ('api_call', 'cache', 'login', 'rate_limit') and
+# ``data`` its fields.
+instrumented = Signal(providing_args=['name', 'data'])
+
+# Sent by janrain.webhooks.ChangeBatcher when Capture reports that entities
+# changed; ``uuids`` is a set of the distinct uuids of type ``type_name``.
+entity_changed = Signal(providing_args=['type_name', 'uuids'])
@@ -4,6 +4,9 @@
                redirect_uri=http%3A//www.example.com/oauth_redirect&
                client_id=your_client_id&
                xd_receiver=http%3A//www.example.com/xdcomm.html"></iframe>
+
+{% janrain_capture_signin domain lazy %} renders a placeholder instead and
+only loads the iframe once it's interacted with or scrolled into view.
 """
 from functools import partial
 import re
@@ -36,32 +39,95 @@ def literal_or_var(thing):
 def maybe_resolve(context, thing):
     return thing.resolve(context) if type(thing) == template.Variable else thing
 
+IFRAME = """
+        <iframe width="500px" height="1000px" src="https://{app_id}.janraincapture.com/oauth/{signin_or_register}?response_type=code&redirect_uri=http://{domain}/janrain/oauth_redirect&client_id={client_id}&xdreceiver=http://{domain}/janrain/xdcomm.html"></iframe>
+        """
+
+# Only a placeholder goes into the page; the iframe is created when the
+# placeholder is interacted with or scrolled into view, while the preconnect
+# hints get the connection to Capture going early.
+LAZY_IFRAME = """
+        <link rel="preconnect" href="https://{app_id}.janraincapture.com">
+        <link rel="dns-prefetch" href="https://{app_id}.janraincapture.com">
+        <div class="janrain-capture" tabindex="0" style="width:500px;height:1000px" data-janrain-capture-src="https://{app_id}.janraincapture.com/oauth/{signin_or_register}?response_type=code&redirect_uri=http://{domain}/janrain/oauth_redirect&client_id={client_id}&xdreceiver=http://{domain}/janrain/xdcomm.html"><a href="#" onclick="return false;">{label}</a></div>
+        <script type="text/javascript">
+        (function () {{
+            var holders = document.querySelectorAll('div[data-janrain-capture-src]');
+            for (var i = 0; i < holders.length; i++) {{
+                wire(holders[i]);
+            }}
+            function wire(holder) {{
+                if (holder.getAttribute('data-janrain-wired')) {{ return; }}
+                holder.setAttribute('data-janrain-wired', '1');
+                var loaded = false;
+                var load = function () {{
+                    if (loaded) {{ return; }}
+                    loaded = true;
+                    var iframe = document.createElement('iframe');
+                    iframe.width = '500px';
+                    iframe.height = '1000px';
+                    iframe.src = holder.getAttribute('data-janrain-capture-src');
+                    holder.innerHTML = '';
+                    holder.appendChild(iframe);
+                }};
+                holder.onclick = holder.onmouseover = holder.onfocus = load;
+                if ('IntersectionObserver' in window) {{
+                    var observer = new IntersectionObserver(function (entries) {{
+                        if (entries[0].isIntersecting) {{
+                            observer.disconnect();
+                            load();
+                        }}
+                    }}, {{rootMargin: '200px'}});
+                    observer.observe(holder);
+                }}
+            }}
+        }})();
+        </script>
+        """
+
 class JanrainCaptureNode(template.Node):
-    def __init__(self, signin_or_register, domain):
-        self.data = dict(
+    # distinct domains to keep rendered output for
+    max_cached = 64
+
+    def __init__(self, signin_or_register, domain, lazy=False):
+        self.domain = literal_or_var(domain)
+        # Everything but the domain is known once the template is compiled, so
+        # fill it in now and keep the pieces to either side of the domain.
+        self.parts = tuple((LAZY_IFRAME if lazy else IFRAME).format(
             signin_or_register=signin_or_register,
-            app_id = settings.JANRAIN_CAPTURE_APP_ID,
-            client_id = settings.JANRAIN_CAPTURE_CLIENT_ID,
-            domain = literal_or_var(domain),
-        )
+            label='Sign in' if signin_or_register == 'signin' else 'Register',
+            app_id=settings.JANRAIN_CAPTURE_APP_ID,
+            client_id=settings.JANRAIN_CAPTURE_CLIENT_ID,
+            domain='{domain}',
+        ).split('{domain}'))
+        self.rendered = {}
 
     def render(self, context):
-        if type(self.data['domain']) == template.Variable:
-            self.data['domain'] = self.data['domain'].resolve(context)
+        domain = maybe_resolve(context, self.domain)
+        try:
+            return self.rendered[domain]
+        except KeyError:
+            pass
 
-        return """
-        <iframe width="500px" height="1000px" src="https://{app_id}.janraincapture.com/oauth/{signin_or_register}?response_type=code&redirect_uri=http://{domain}/janrain/oauth_redirect&client_id={client_id}&xdreceiver=http://{domain}/janrain/xdcomm.html"></iframe>
-        """.format(**self.data)
+        html = (u'%s' % domain).join(self.parts)
+        # nodes live as long as the compiled template; don't grow without bound
+        if len(self.rendered) >= self.max_cached:
+            self.rendered.clear()
+        self.rendered[domain] = html
+        return html
 
 def janrain_capture(signin_or_register, parser, token):
     if signin_or_register not in ('signin', 'register'):
         raise ValueError("you're probably doing this wrong, see janrain_capture_signin and janrain_capture_register")
-    try:
-        tag_name, domain = token.split_contents()
-    except ValueError:
-        raise template.TemplateSyntaxError('janrain_capture tag requires domain argument')
+    bits = token.split_contents()
+    if len(bits) == 2:
+        lazy = False
+    elif len(bits) == 3 and bits[2] == 'lazy':
+        lazy = True
+    else:
+        raise template.TemplateSyntaxError('janrain_capture tag requires domain argument, optionally followed by lazy')
 
-    return JanrainCaptureNode(signin_or_register, domain)
+    return JanrainCaptureNode(signin_or_register, bits[1], lazy=lazy)
 
 register = template.Library()
 register.tag('janrain_capture_signin', partial(janrain_capture, 'signin'))
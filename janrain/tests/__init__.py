@@ -1,2 +1,35 @@
-from janrain.tests.test_api import TestAPI
-from janrain.tests.test_backend import TestBackend
+from django.test.signals import setting_changed
+
+from janrain import api, codec, instrumentation
+
+def reset_janrain(sender, setting, **kwargs):
+    """
+        override_settings receiver: drops anything janrain built from the old
+        value of a JANRAIN_* setting.
+    """
+    if not setting.startswith('JANRAIN_'):
+        return
+    api.clear_clients()
+    api.reset_session()
+    api.clear_breakers()
+    if setting == 'JANRAIN_JSON_CODEC':
+        codec.load_codec()
+    elif setting == 'JANRAIN_INSTRUMENTATION_SINKS':
+        instrumentation.load_sinks()
+
+setting_changed.connect(reset_janrain, dispatch_uid='janrain.tests.reset_janrain')
+
+from janrain.tests.test_api import TestAPI, TestSession, TestClientRegistry, TestAsyncClient, TestFanOut, TestStreaming, TestIterEntities, TestResilience, TestRefreshToken, TestSingleFlight
+from janrain.tests.test_backend import TestJanrainUserEngage, TestBackend, TestBackendUserCache, TestJanrainUserMemo, TestJanrainUserCapture, TestProfileSync, TestIdentities
+from janrain.tests.test_cache import TestEntityCache, TestClientEntityCache
+from janrain.tests.test_provisioning import TestImportUsers
+from janrain.tests.test_tokens import TestTokenStore
+from janrain.tests.test_instrumentation import TestInstrumentation, TestHistogram, TestStatsdSink
+from janrain.tests.test_fake_capture import TestFakeCapture
+from janrain.tests.test_templatetags import TestJanrainCaptureTags
+from janrain.tests.test_views import TestStaticTemplateViews, TestWebhookView, TestLogoutView, TestEngageLoginView
+from janrain.tests.test_writebehind import TestMerge, TestMemoryBackend, TestDatabaseBackend, TestCacheBackend, TestWriteBehindQueue, TestCreateUnlessExists
+from janrain.tests.test_mirror import TestProfileMirror, TestMirrorSettings, TestMirrorInvalidation
+from janrain.tests.test_webhooks import TestChangeBatcher, TestInvalidation
+from janrain.tests.test_ratelimit import TestBuckets, TestRateLimiter, TestClientRateLimit
+from janrain.tests.test_codec import TestCodec
@@ -0,0 +1,97 @@
+"""
+Micro-benchmark of the JSON codecs JANRAIN_JSON_CODEC can choose from.
+
+    DJANGO_SETTINGS_MODULE=janrain.tests.settings \\
+        python -m janrain.tests.bench_codec --out codecs.json
+
+Decodes ``entity`` responses (from bytes, as JanrainClient does) and encodes
+entity updates of a small and a large nested Capture entity with the stdlib
+and with each of ``--codecs`` that is installed, and writes the time per
+operation to --out as JSON.
+"""
+from optparse import OptionParser
+import json
+import platform
+import time
+
+import janrain
+from janrain.codec import StdlibCodec, import_codec
+from janrain.tests.fake_capture import make_entity
+
+def nested_entity(uuid, payload_size):
+    """
+        A Capture entity shaped like a real one: plurals of objects, nested
+        objects and non-ASCII text, padded to about payload_size bytes.
+    """
+    entity = make_entity(uuid, 0)
+    entity.update(
+        primaryAddress=dict(address1=u'1 Rue de la Paix', city=u'Paris', zip='75002', country='FR'),
+        profiles=[dict(
+            id=i,
+            domain='facebook.com',
+            identifier='http://www.facebook.com/profile.php?id=%d' % i,
+            profile=dict(displayName=u'Nat\xe9 %d' % i, verifiedEmail='%s@example.com' % uuid,
+                accounts=[dict(domain='example.com', userid=str(j)) for j in range(3)]),
+            friends=['friend-%d' % j for j in range(10)],
+        ) for i in range(3)],
+    )
+    body = json.dumps(dict(stat='ok', result=entity))
+    entity['aboutMe'] = 'x' * max(0, payload_size - len(body))
+    return entity
+
+def per_operation(func, arg, seconds):
+    """
+    :returns: microseconds per call of func(arg), repeated for about seconds
+    """
+    calls = 0
+    started = time.time()
+    while True:
+        for i in xrange(100):
+            func(arg)
+        calls += 100
+        elapsed = time.time() - started
+        if elapsed >= seconds:
+            return round(elapsed / calls * 1e6, 2)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--out', default='codecs.json', help='JSON results file. Default: codecs.json')
+    parser.add_option('--codecs', default='simplejson,ujson',
+        help='Comma separated codecs to compare with the stdlib. Default: simplejson,ujson')
+    parser.add_option('--sizes', default='2048,65536', help='Comma separated entity sizes, bytes. Default: 2048,65536')
+    parser.add_option('--seconds', type='float', default=0.5, help='Time per measurement. Default: 0.5')
+    options, args = parser.parse_args()
+
+    codecs = [StdlibCodec()]
+    for path in options.codecs.split(','):
+        try:
+            codecs.append(import_codec(path))
+        except ImportError:
+            print '%s is not installed, skipping' % path
+
+    results = []
+    for size in [int(s) for s in options.sizes.split(',')]:
+        entity = nested_entity('user-1', size)
+        body = json.dumps(dict(stat='ok', result=entity))
+        for codec in codecs:
+            if codec.loads(body) != json.loads(body):
+                raise AssertionError('%s decodes differently' % codec.name)
+            result = dict(
+                codec=codec.name,
+                bytes=len(body),
+                loads_us=per_operation(codec.loads, body, options.seconds),
+                dumps_us=per_operation(codec.dumps, entity, options.seconds),
+            )
+            print '%(codec)-12s %(bytes)8d bytes  loads %(loads_us)10sus  dumps %(dumps_us)10sus' % result
+            results.append(result)
+
+    with open(options.out, 'w') as f:
+        json.dump(dict(
+            version='.'.join(map(str, janrain.__version__)),
+            python=platform.python_version(),
+            results=results,
+        ), f, indent=2)
+    print 'wrote %s' % options.out
+
+if __name__ == '__main__':
+    main()
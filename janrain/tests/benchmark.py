@@ -0,0 +1,162 @@
+"""
+Throughput and latency benchmarks against a local fake Capture server.
+
+    DJANGO_SETTINGS_MODULE=janrain.tests.settings \\
+        python -m janrain.tests.benchmark --out bench.json
+
+Drives JanrainClient.entity, JanrainBackend.authenticate and the whole
+JanrainOauthRedirectView flow (through Django's test client) at each
+concurrency level and writes throughput and latency percentiles to --out as
+JSON, so runs from different releases can be compared.
+"""
+from optparse import OptionParser
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.test.client import Client
+from django.test.utils import override_settings, setup_test_environment
+from django.db import connection
+
+import janrain
+from janrain.api import JanrainClient
+from janrain.backends import JanrainBackend
+from janrain.tests.fake_capture import FakeCaptureServer, make_entity
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run(name, operation, total, concurrency):
+    """
+        Calls operation(i) for i in range(total) on ``concurrency`` threads.
+
+        :returns: dict of results for this scenario and concurrency level
+    """
+    latencies = []
+    errors = []
+    counter = iter(xrange(total))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            started = time.time()
+            try:
+                operation(i)
+            except Exception as e:
+                errors.append(repr(e))
+            else:
+                latencies.append(time.time() - started)
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    ms = lambda s: None if s is None else round(s * 1000, 3)
+    return dict(
+        scenario=name,
+        concurrency=concurrency,
+        operations=total,
+        errors=len(errors),
+        first_error=errors[0] if errors else None,
+        seconds=round(elapsed, 3),
+        throughput=round(len(latencies) / elapsed, 1) if elapsed else None,
+        p50_ms=ms(percentile(latencies, 50)),
+        p90_ms=ms(percentile(latencies, 90)),
+        p99_ms=ms(percentile(latencies, 99)),
+        max_ms=ms(latencies[-1] if latencies else None),
+    )
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--out', default='bench.json', help='JSON results file. Default: bench.json')
+    parser.add_option('--requests', type='int', default=200, help='Operations per run. Default: 200')
+    parser.add_option('--concurrency', default='1,4,16', help='Comma separated thread counts. Default: 1,4,16')
+    parser.add_option('--latency', type='float', default=0.02, help='Fake server latency, seconds. Default: 0.02')
+    parser.add_option('--payload', type='int', default=2048, help='Bytes of padding per entity. Default: 2048')
+    parser.add_option('--users', type='int', default=100, help='Distinct users logging in. Default: 100')
+    options, args = parser.parse_args()
+    levels = [int(c) for c in options.concurrency.split(',')]
+
+    server = FakeCaptureServer(latency=options.latency, payload_size=options.payload).start()
+
+    fd, db_name = tempfile.mkstemp(suffix='.sqlite3')
+    os.close(fd)
+    settings.DATABASES['default']['TEST_NAME'] = db_name
+    settings.DATABASES['default'].setdefault('OPTIONS', {})['timeout'] = 30
+    overrides = override_settings(
+        ROOT_URLCONF='janrain.tests.urls',
+        AUTHENTICATION_BACKENDS=('janrain.backends.JanrainBackend',),
+        SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies',
+        JANRAIN_CAPTURE_API_URL=server.url,
+        JANRAIN_CAPTURE_CLIENT_ID='bench',
+        JANRAIN_CAPTURE_CLIENT_SECRET='bench',
+        JANRAIN_CAPTURE_APP_ID='bench',
+        JANRAIN_API_KEY='bench',
+    )
+    overrides.enable()
+    setup_test_environment()
+    old_db_name = settings.DATABASES['default']['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    client = JanrainClient('bench', 'bench', server.url)
+    backend = JanrainBackend()
+    uuid = lambda i: 'user-%d' % (i % options.users)
+    entities = [make_entity(uuid(i), options.payload) for i in range(options.users)]
+
+    def oauth_flow(i):
+        response = Client().get('/janrain/oauth_redirect', dict(code=uuid(i)))
+        if response.status_code != 302 or not response['Location'].endswith('/janrain/return.html'):
+            raise AssertionError('login failed: %s %s' % (response.status_code, response.get('Location')))
+
+    scenarios = [
+        ('client.entity', lambda i: client.entity(uuid(i), 'user')),
+        ('backend.authenticate', lambda i: backend.authenticate(entities[i % options.users])),
+        ('oauth_redirect', oauth_flow),
+    ]
+
+    results = []
+    try:
+        # first logins create the users; measure steady state after that
+        for entity in entities:
+            backend.authenticate(entity)
+        for name, operation in scenarios:
+            for concurrency in levels:
+                result = run(name, operation, options.requests, concurrency)
+                print '%(scenario)-22s c=%(concurrency)-3d %(throughput)8s/s  p50 %(p50_ms)8sms  p99 %(p99_ms)8sms  errors %(errors)d' % result
+                results.append(result)
+    finally:
+        connection.creation.destroy_test_db(old_db_name, verbosity=0)
+        overrides.disable()
+        server.stop()
+        if os.path.exists(db_name):
+            os.unlink(db_name)
+
+    with open(options.out, 'w') as f:
+        json.dump(dict(
+            version='.'.join(map(str, janrain.__version__)),
+            python=platform.python_version(),
+            latency=options.latency,
+            payload=options.payload,
+            requests=options.requests,
+            results=results,
+        ), f, indent=2)
+    print 'wrote %s' % options.out
+
+if __name__ == '__main__':
+    main()
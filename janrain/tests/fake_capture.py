@@ -0,0 +1,108 @@
+"""
+A stand-in for the Janrain Capture and Engage APIs, served locally over HTTP
+for benchmarks and integration tests.
+
+    server = FakeCaptureServer(latency=0.05, payload_size=4096).start()
+    client = JanrainClient('id', 'secret', server.url)
+    ...
+    server.stop()
+
+OAuth codes are user uuids: a code exchanges for the access token
+'token-<uuid>', and that token reads back the entity with that uuid.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import threading
+import time
+import urlparse
+
+def make_entity(uuid, payload_size=1024):
+    return dict(
+        uuid=uuid,
+        id=abs(hash(uuid)) % 1000000,
+        email='%s@example.com' % uuid,
+        givenName='Given %s' % uuid,
+        familyName='Family',
+        displayName=uuid,
+        aboutMe='x' * payload_size,
+        statuses=[dict(id=i, status='active', created='2012-01-01 00:00:00') for i in range(5)],
+    )
+
+class FakeCaptureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send headers and body in one segment, as a real server would
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.respond(urlparse.parse_qs(urlparse.urlsplit(self.path).query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        self.respond(urlparse.parse_qs(body))
+
+    def respond(self, params):
+        server = self.server
+        time.sleep(server.latency)
+        server.cookies_received.append(self.headers.getheader('cookie'))
+        path = urlparse.urlsplit(self.path).path.strip('/')
+        params = dict((k, v[0]) for k, v in params.items())
+        payload_size = server.payload_size
+
+        if path == 'oauth/token':
+            uuid = params.get('code') or params.get('refresh_token')
+            data = dict(stat='ok', access_token='token-%s' % uuid,
+                refresh_token=uuid, expires_in=3600)
+        elif path == 'entity':
+            auth = self.headers.getheader('authorization') or ''
+            uuid = params.get('uuid') or auth.split('token-', 1)[-1]
+            data = dict(stat='ok', result=make_entity(uuid, payload_size))
+        elif path == 'entity.update':
+            data = dict(stat='ok')
+        elif path == 'entity.find':
+            first = int(params.get('first_result', 0))
+            count = max(0, min(int(params.get('max_results', 100)), server.entity_count - first))
+            data = dict(stat='ok', result_count=count, results=[
+                make_entity('uuid-%d' % i, payload_size) for i in range(first, first + count)])
+        elif path == 'auth_info':
+            data = dict(stat='ok', profile=dict(identifier=params.get('token')))
+        elif path == 'clients/list':
+            data = dict(stat='ok', results=[])
+        else:
+            data = dict(stat='error', error='unknown_method', code=100)
+
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if server.cookie:
+            self.send_header('Set-Cookie', server.cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeCaptureServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, payload_size=1024, entity_count=1000, port=0, cookie=None):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeCaptureHandler)
+        self.latency = latency
+        self.payload_size = payload_size
+        self.entity_count = entity_count
+        # a Set-Cookie header to send, like a sticky load balancer
+        self.cookie = cookie
+        self.cookies_received = []
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
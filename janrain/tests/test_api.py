@@ -1,12 +1,21 @@
 import json
 import mock
+import requests
+import threading
+import time
+from django.test.utils import override_settings
 from unittest2 import TestCase
 
+from janrain import api
 from janrain.api import JanrainClient
 
 class MockRequestsJsonResponse(object):
-    def __init__(self, data):
+    def __init__(self, data, status_code=200):
         self.content = json.dumps(data)
+        self.status_code = status_code
+
+    def close(self):
+        pass
 
 class TestAPI(TestCase):
     def setUp(self):
@@ -16,7 +25,7 @@ class TestAPI(TestCase):
 
     def test__make_request_get(self):
         self.reqs.get = mock.Mock(return_value=MockRequestsJsonResponse(dict(hello='there')))
-        with mock.patch('janrain.api.requests', self.reqs):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
             response = self.client._make_request('path')
 
             self.assertEqual(len(response.keys()), 1, 'got back our json')
@@ -24,13 +33,13 @@ class TestAPI(TestCase):
 
     def test__make_request_get_args(self):
         self.reqs.get = mock.Mock(return_value=MockRequestsJsonResponse(dict(hello='there')))
-        with mock.patch('janrain.api.requests', self.reqs):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
             self.client._make_request('path', data=dict(ohno='youdidnt'))
-            self.reqs.get.assert_called_with('path', headers=dict(), params=dict(ohno='youdidnt'))
+            self.reqs.get.assert_called_with('path', headers=dict(), timeout=10, params=dict(ohno='youdidnt'))
 
     def test__make_request_post(self):
         self.reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(you='guys')))
-        with mock.patch('janrain.api.requests', self.reqs):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
             response = self.client._make_request('path', method='post')
 
             self.assertEqual(len(response.keys()), 1, 'got back our json')
@@ -38,25 +47,25 @@ class TestAPI(TestCase):
 
     def test__make_request_post_args(self):
         self.reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(you='guys')))
-        with mock.patch('janrain.api.requests', self.reqs):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
             self.client._make_request('path', method='post', data=dict(ohno='youdidnt'))
-            self.reqs.post.assert_called_with('path', headers=dict(), data=dict(ohno='youdidnt'))
+            self.reqs.post.assert_called_with('path', headers=dict(), timeout=10, data=dict(ohno='youdidnt'))
 
     def test__make_request_bad_method(self):
         self.assertRaises(ValueError, self.client._make_request, 'path', method='foobarbaz')
 
     def test__make_request_headers(self):
         self.reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(you='guys')))
-        with mock.patch('janrain.api.requests', self.reqs):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
             self.client._make_request('path', method='post', headers=dict(Authorization="oauth"), data=dict(ohno='youdidnt'))
-            self.reqs.post.assert_called_with('path', headers=dict(Authorization="oauth"), data=dict(ohno='youdidnt'))
+            self.reqs.post.assert_called_with('path', headers=dict(Authorization="oauth"), timeout=10, data=dict(ohno='youdidnt'))
 
     def test_clients_add_no_features(self):
         self.reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(hello='there')))
-        with mock.patch('janrain.api.requests', self.reqs):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
             resp = self.client.clients_add('description')
             self.assertEqual(resp['hello'], 'there', 'got back our json')
-            self.reqs.post.assert_called_with('clients/add', headers={}, data=dict(
+            self.reqs.post.assert_called_with('clients/add', headers={}, timeout=10, data=dict(
                 client_id=1,
                 client_secret=2,
                 description='description'
@@ -64,10 +73,10 @@ class TestAPI(TestCase):
 
     def test_clients_add_with_features(self):
         self.reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(hello='there')))
-        with mock.patch('janrain.api.requests', self.reqs):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
             resp = self.client.clients_add('description', ["feature"])
             self.assertEqual(resp['hello'], 'there', 'got back our json')
-            self.reqs.post.assert_called_with('clients/add', headers={}, data=dict(
+            self.reqs.post.assert_called_with('clients/add', headers={}, timeout=10, data=dict(
                 client_id=1,
                 client_secret=2,
                 features='["feature"]',
@@ -76,10 +85,10 @@ class TestAPI(TestCase):
 
     def test_settings_set_multi(self):
         self.reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(hello='there')))
-        with mock.patch('janrain.api.requests', self.reqs):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
             resp = self.client.settings_set_multi('for_client_id', {'setting': 'value'})
             self.assertEqual(resp['hello'], 'there', 'got back our json')
-            self.reqs.post.assert_called_with('settings/set_multi', headers={}, data=dict(
+            self.reqs.post.assert_called_with('settings/set_multi', headers={}, timeout=10, data=dict(
                 client_id=1,
                 client_secret=2,
                 for_client_id='for_client_id',
@@ -88,10 +97,346 @@ class TestAPI(TestCase):
 
     def test_clients_list(self):
         self.reqs.get = mock.Mock(return_value=MockRequestsJsonResponse(dict(hello='there')))
-        with mock.patch('janrain.api.requests', self.reqs):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
             resp = self.client.clients_list()
             self.assertEqual(resp['hello'], 'there', 'got back our json')
-            self.reqs.get.assert_called_with('clients/list', headers={}, params=dict(
+            self.reqs.get.assert_called_with('clients/list', headers={}, timeout=10, params=dict(
+                client_id=1,
+                client_secret=2,
+            ))
+
+class TestSession(TestCase):
+    def tearDown(self):
+        api.reset_session()
+
+    def test_session_shared(self):
+        self.assertTrue(api.get_session() is api.get_session(), 'one session per process')
+
+    def test_session_pool_settings(self):
+        with override_settings(JANRAIN_HTTP_POOL_MAXSIZE=42):
+            api.reset_session()
+            adapter = api.get_session().get_adapter('https://example.janraincapture.com/')
+            self.assertEqual(adapter._pool_maxsize, 42)
+
+    def test_session_idle_timeout(self):
+        session = api.get_session()
+        with mock.patch('janrain.api.time') as mtime:
+            mtime.time.return_value = time.time() + 3600
+            self.assertFalse(api.get_session() is session, 'idle session replaced')
+
+class TestClientRegistry(TestCase):
+    def tearDown(self):
+        api.clear_clients()
+
+    def test_get_client_reused(self):
+        client = api.get_client(1, 2, 'test_endpoint')
+        self.assertTrue(client is api.get_client(1, 2, 'test_endpoint'), 'same client for same key')
+        self.assertFalse(client is api.get_client(1, 3, 'test_endpoint'), 'new client for new credentials')
+
+    def test_setting_changed_clears(self):
+        client = api.get_client(1, 2, 'test_endpoint')
+        with override_settings(JANRAIN_CAPTURE_CLIENT_ID=5):
+            self.assertFalse(client is api.get_client(1, 2, 'test_endpoint'), 'registry cleared')
+
+    def test_auth_info(self):
+        reqs = mock.Mock()
+        reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(stat='ok')))
+        with mock.patch('janrain.api.get_session', return_value=reqs):
+            api.get_client(None, 'key', 'test_endpoint').auth_info('token')
+            reqs.post.assert_called_with('auth_info', headers={}, timeout=10, data=dict(apiKey='key', token='token'))
+
+class TestAsyncClient(TestCase):
+    def setUp(self):
+        self.client = api.AsyncJanrainClient(client_id=1, client_secret=2, api_url='test_endpoint')
+        self.reqs = mock.Mock()
+
+    def test_entity(self):
+        self.reqs.get = mock.Mock(return_value=MockRequestsJsonResponse(dict(stat='ok')))
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            result = self.client.entity(access_token='token')
+            self.assertEqual(result.get(timeout=5), dict(stat='ok'))
+            self.reqs.get.assert_called_with('entity', headers=dict(Authorization='OAuth token'), timeout=10, params={})
+
+    def test_exception_raised_on_get(self):
+        result = self.client.entity()
+        self.assertRaises(ValueError, result.get, 5)
+
+    def test_get_async_client_shares_client(self):
+        client = api.get_async_client(1, 2, 'test_endpoint').client
+        self.assertTrue(client is api.get_client(1, 2, 'test_endpoint'))
+        api.clear_clients()
+
+class TestFanOut(TestCase):
+    def setUp(self):
+        self.client = JanrainClient(client_id=1, client_secret=2, api_url='test_endpoint')
+        self.reqs = mock.Mock()
+
+    def test_entity_many_in_order(self):
+        def post(url, headers, data, timeout):
+            time.sleep(0.01 * (5 - int(data['uuid'])))
+            return MockRequestsJsonResponse(dict(result=dict(uuid=data['uuid'])))
+        self.reqs.post = post
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            uuids = [str(i) for i in range(5)]
+            results = list(self.client.entity_many(iter(uuids), 'user', concurrency=3))
+            self.assertEqual([r[0] for r in results], uuids, 'results come back in order')
+            self.assertEqual([r[1]['result']['uuid'] for r in results], uuids)
+            self.assertEqual([r[2] for r in results], [None] * 5)
+
+    def test_entity_update_many_errors(self):
+        def post(url, headers, data, timeout):
+            if data['uuid'] == 'b':
+                raise IOError('boom')
+            return MockRequestsJsonResponse(dict(stat='ok'))
+        self.reqs.post = post
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            results = list(self.client.entity_update_many([('a', {}), ('b', {}), ('c', {})], 'user'))
+            self.assertEqual([r[0] for r in results], ['a', 'b', 'c'])
+            self.assertEqual(results[0][1], dict(stat='ok'))
+            self.assertEqual(results[1][1], None)
+            self.assertTrue(isinstance(results[1][2], IOError), 'error reported per item')
+            self.assertEqual(results[2][2], None)
+
+class MockStreamingResponse(object):
+    def __init__(self, data, chunk_size=7):
+        self.content = json.dumps(data)
+        self.status_code = 200
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), self.chunk_size):
+            yield self.content[i:i + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+class TestStreaming(TestCase):
+    def setUp(self):
+        self.client = JanrainClient(client_id=1, client_secret=2, api_url='test_endpoint')
+        self.reqs = mock.Mock()
+
+    def test_iter_results(self):
+        results = [dict(uuid=str(i), n=i * 1000, names=dict(given=u'n\xe9te', tags=['a', 'b'])) for i in range(20)]
+        response = MockStreamingResponse(dict(result_count=20, results=results, stat='ok'))
+        self.assertEqual(list(api.iter_results(response, 'entity.find')), results)
+        self.assertTrue(response.closed, 'connection released')
+
+    def test_iter_results_error(self):
+        response = MockStreamingResponse(dict(stat='error', error='access_failure', code=402))
+        self.assertRaises(api.APIException, list, api.iter_results(response, 'clients/list'))
+
+    def test_iter_results_malformed(self):
+        response = MockStreamingResponse(dict(results=[1, 2]))
+        response.content = response.content[:-5]
+        self.assertRaises(api.APIException, list, api.iter_results(response, 'clients/list'))
+
+    def test_clients_list_stream(self):
+        self.reqs.get = mock.Mock(return_value=MockStreamingResponse(dict(stat='ok', results=[1, 2, 3])))
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.assertEqual(list(self.client.clients_list(stream=True)), [1, 2, 3])
+            self.reqs.get.assert_called_with('clients/list', headers={}, stream=True, timeout=10, params=dict(
                 client_id=1,
                 client_secret=2,
             ))
+
+class TestIterEntities(TestCase):
+    def setUp(self):
+        self.client = JanrainClient(client_id=1, client_secret=2, api_url='test_endpoint')
+        self.records = [dict(uuid=str(i)) for i in range(5)]
+
+    def test_pages(self):
+        with mock.patch.object(self.client, 'entity_find') as mfind:
+            mfind.side_effect = [
+                dict(stat='ok', results=self.records[:2]),
+                dict(stat='ok', results=self.records[2:4]),
+                dict(stat='ok', results=self.records[4:]),
+            ]
+            records = list(self.client.iter_entities('user', attributes=['uuid'], page_size=2))
+            self.assertEqual(records, self.records)
+            mfind.assert_called_with('user', filter=None, attributes=['uuid'], first_result=4, max_results=2)
+
+    def test_prefetch(self):
+        with mock.patch.object(self.client, 'entity_find') as mfind:
+            mfind.side_effect = [
+                dict(stat='ok', results=self.records[:2]),
+                dict(stat='ok', results=self.records[2:4]),
+            ]
+            records = self.client.iter_entities('user', page_size=2)
+            next(records)
+            time.sleep(0.1)
+            self.assertEqual(mfind.call_count, 2, 'second page requested before the first is consumed')
+
+    def test_error(self):
+        with mock.patch.object(self.client, 'entity_find') as mfind:
+            mfind.return_value = dict(stat='error', error='bad filter')
+            self.assertRaises(api.APIException, list, self.client.iter_entities('user'))
+
+class TestResilience(TestCase):
+    def setUp(self):
+        self.client = JanrainClient(client_id=1, client_secret=2, api_url='http://capture.example.com/')
+        self.reqs = mock.Mock()
+        self.settings = override_settings(JANRAIN_HTTP_RETRY_BACKOFF=0, JANRAIN_BREAKER_THRESHOLD=5)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def test_retry_idempotent(self):
+        self.reqs.get = mock.Mock(side_effect=[
+            requests.Timeout('slow'),
+            MockRequestsJsonResponse(dict(stat='error'), status_code=503),
+            MockRequestsJsonResponse(dict(stat='ok')),
+        ])
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.assertEqual(self.client.clients_list(), dict(stat='ok'))
+            self.assertEqual(self.reqs.get.call_count, 3)
+
+    def test_no_retry_non_idempotent(self):
+        self.reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(stat='error'), status_code=502))
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.assertRaises(api.APIException, self.client.oauth_token, 'code', 'uri')
+            self.assertEqual(self.reqs.post.call_count, 1)
+
+    def test_bad_response(self):
+        response = MockRequestsJsonResponse(None)
+        response.content = '<html>oops</html>'
+        self.reqs.post = mock.Mock(return_value=response)
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.assertRaises(api.APIException, self.client.oauth_token, 'code', 'uri')
+
+    def test_circuit_breaker(self):
+        self.reqs.get = mock.Mock(side_effect=requests.ConnectionError('down'))
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.assertRaises(api.APIException, self.client.clients_list)
+            self.assertEqual(api.breaker_status()['capture.example.com']['state'], 'closed')
+            self.assertRaises(api.APIException, self.client.clients_list)
+            self.assertEqual(api.breaker_status()['capture.example.com']['state'], 'open')
+            self.assertEqual(self.reqs.get.call_count, 5, 'stopped retrying once open')
+            self.assertRaises(api.CircuitOpenException, self.client.clients_list)
+            self.assertEqual(self.reqs.get.call_count, 5, 'failed fast')
+
+    def test_circuit_breaker_half_open(self):
+        breaker = api.CircuitBreaker(threshold=1, reset=30)
+        breaker.failure()
+        self.assertRaises(api.CircuitOpenException, breaker.before_call, 'entity')
+        with mock.patch('janrain.api.time') as mtime:
+            mtime.time.return_value = time.time() + 31
+            breaker.before_call('entity')
+            self.assertEqual(breaker.state, breaker.HALF_OPEN)
+            self.assertRaises(api.CircuitOpenException, breaker.before_call, 'entity')
+        breaker.success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_half_open_trial_lapses(self):
+        breaker = api.CircuitBreaker(threshold=1, reset=30)
+        breaker.failure()
+        with mock.patch('janrain.api.time') as mtime:
+            mtime.time.return_value = time.time() + 31
+            breaker.before_call('entity')
+            mtime.time.return_value += 31
+            breaker.before_call('entity')
+            self.assertEqual(breaker.state, breaker.HALF_OPEN, 'unfinished trial replaced')
+
+    def test_other_request_errors(self):
+        self.reqs.get = mock.Mock(side_effect=[
+            requests.exceptions.ChunkedEncodingError('cut off'),
+            MockRequestsJsonResponse(dict(stat='ok')),
+        ])
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.assertEqual(self.client.clients_list(), dict(stat='ok'), 'retried')
+
+        self.reqs.post = mock.Mock(side_effect=requests.TooManyRedirects('loop'))
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.assertRaises(api.APIException, self.client.oauth_token, 'code', 'uri')
+
+    def test_half_open_trial_settled(self):
+        breaker = api.get_breaker('http://capture.example.com/')
+        breaker.state, breaker.opened_at = breaker.OPEN, time.time() - 31
+        self.reqs.post = mock.Mock(side_effect=requests.exceptions.ChunkedEncodingError('cut off'))
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.assertRaises(api.APIException, self.client.oauth_token, 'code', 'uri')
+        self.assertEqual(breaker.state, breaker.OPEN, 'failed trial re-opens')
+
+        breaker.opened_at = time.time() - 31
+        self.reqs.post = mock.Mock(side_effect=KeyError('bug'))
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.assertRaises(KeyError, self.client.oauth_token, 'code', 'uri')
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        breaker.opened_at = time.time() - 31
+        self.reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(stat='ok')))
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.assertEqual(self.client.oauth_token('code', 'uri'), dict(stat='ok'))
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+class TestRefreshToken(TestCase):
+    def test_refresh_token(self):
+        client = JanrainClient(client_id=1, client_secret=2, api_url='test_endpoint')
+        reqs = mock.Mock()
+        reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(access_token='a')))
+        with mock.patch('janrain.api.get_session', return_value=reqs):
+            self.assertEqual(client.refresh_token('r'), dict(access_token='a'))
+            reqs.post.assert_called_with('oauth/token', headers={}, timeout=10, data=dict(
+                refresh_token='r',
+                grant_type='refresh_token',
+                client_id=1,
+                client_secret=2,
+            ))
+
+class TestSingleFlight(TestCase):
+    def setUp(self):
+        self.client = JanrainClient(client_id=1, client_secret=2, api_url='test_endpoint')
+        self.reqs = mock.Mock()
+        self.release = threading.Event()
+
+    def slow(self, *args, **kwargs):
+        self.release.wait(5)
+        return MockRequestsJsonResponse(dict(stat='ok'))
+
+    def call_concurrently(self, func, count=5):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(func())) for i in range(count)]
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            self.release.set()
+            for thread in threads:
+                thread.join()
+        return results
+
+    def test_reads_share_one_call(self):
+        self.reqs.post = mock.Mock(side_effect=self.slow)
+        results = self.call_concurrently(lambda: self.client.entity('u1', 'user'))
+        self.assertEqual(results, [dict(stat='ok')] * 5)
+        self.assertEqual(self.reqs.post.call_count, 1)
+        self.assertEqual(api.single_flight.in_flight(), 0)
+
+    def test_followers_get_copies(self):
+        self.reqs.post = mock.Mock(side_effect=self.slow)
+        results = self.call_concurrently(lambda: self.client.entity('u1', 'user'), count=3)
+        results[0]['mine'] = True
+        self.assertEqual(results[1:], [dict(stat='ok')] * 2)
+        self.assertEqual(len(set(id(result) for result in results)), 3)
+
+    def test_different_tokens_not_shared(self):
+        self.reqs.get = mock.Mock(side_effect=self.slow)
+        tokens = iter(['a', 'b', 'c'])
+        lock = threading.Lock()
+        def read():
+            with lock:
+                token = next(tokens)
+            return self.client.entity(access_token=token)
+        self.call_concurrently(read, count=3)
+        self.assertEqual(self.reqs.get.call_count, 3)
+
+    def test_writes_not_shared(self):
+        self.reqs.post = mock.Mock(side_effect=self.slow)
+        self.call_concurrently(lambda: self.client.entity_update('u1', 'user', {}), count=3)
+        self.assertEqual(self.reqs.post.call_count, 3)
+
+    def test_errors_shared(self):
+        flight = api.SingleFlight()
+        self.assertRaises(ValueError, flight.do, 'key', int, 'nope')
+        self.assertEqual(flight.in_flight(), 0)
@@ -1,8 +1,12 @@
 from django.contrib.auth.models import User
+from django.core.cache import cache as default_cache
+from django.test.utils import override_settings
+from hashlib import sha1
 import mock
 from unittest2 import TestCase
 
-from janrain.backends import JanrainBackend, JanrainUser
+from janrain.backends import JanrainBackend, JanrainUser, user_cache
+from janrain.models import JanrainIdentity
 
 class TestJanrainUserEngage(TestCase):
     def setUp(self):
@@ -21,6 +25,10 @@ class TestJanrainUserEngage(TestCase):
         )
         self.user = JanrainUser(self.user_data)
 
+    def test_uuid(self):
+        self.assertEqual(self.user.uuid, '123456789')
+        self.assertEqual(self.user.provider, 'engage')
+
     def test_get_names_first_and_last(self):
         fname, lname = self.user.names
         self.assertEqual(fname, 'nate')
@@ -120,3 +128,120 @@ class TestBackend(TestCase):
             self.muser.objects.get.side_effect = self.muser.DoesNotExist
             self.assertEqual(self.backend.find_user(self.janrain_user), None)
 
+
+class TestBackendUserCache(TestCase):
+    def setUp(self):
+        self.settings = override_settings(JANRAIN_USER_CACHE=dict(BACKEND='locmem://'))
+        self.settings.enable()
+        self.backend = JanrainBackend()
+        self.janrain_user = JanrainUser(dict(uuid='123456789'))
+        self.user = User.objects.create(username=self.janrain_user.hashed)
+
+    def tearDown(self):
+        user_cache().clear()
+        User.objects.all().delete()
+        self.settings.disable()
+
+    def test_find_user_cached(self):
+        self.assertEqual(self.backend.find_user(self.janrain_user), self.user)
+        with mock.patch('janrain.backends.User.objects') as mobjects:
+            self.assertEqual(self.backend.find_user(self.janrain_user), self.user)
+            self.assertFalse(mobjects.get.called, 'no query on repeat login')
+
+    def test_get_user_cached(self):
+        self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        with mock.patch('janrain.backends.User.objects') as mobjects:
+            self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+            self.assertFalse(mobjects.get.called, 'no query on repeat request')
+
+    def test_save_invalidates(self):
+        self.backend.get_user(self.user.pk)
+        self.user.first_name = 'nate'
+        self.user.save()
+        self.assertEqual(self.backend.get_user(self.user.pk).first_name, 'nate')
+
+    def test_delete_invalidates(self):
+        self.backend.find_user(self.janrain_user)
+        self.user.delete()
+        self.assertEqual(self.backend.find_user(self.janrain_user), None)
+
+class TestJanrainUserMemo(TestCase):
+    def test_hashed_once(self):
+        user = JanrainUser(dict(uuid='123456789'))
+        with mock.patch('janrain.backends.sha1', wraps=sha1) as msha1:
+            self.assertEqual(user.hashed, user.hashed)
+            self.assertEqual(msha1.call_count, 1, 'hash computed once')
+
+    def test_no_uuid(self):
+        user = JanrainUser(dict(givenName='nate'))
+        self.assertEqual(user.names, ('nate', ''))
+        self.assertRaises(ValueError, getattr, user, 'hashed')
+
+    def test_slots(self):
+        self.assertRaises(AttributeError, setattr, JanrainUser({}), 'foo', 1)
+
+class TestProfileSync(TestCase):
+    def setUp(self):
+        self.settings = override_settings(JANRAIN_SYNC_PROFILE=True)
+        self.settings.enable()
+        self.backend = JanrainBackend()
+        self.user_data = dict(uuid='123456789', givenName='nate', familyName='smith', email='nate@example.com')
+        self.user = self.backend.authenticate(self.user_data)
+
+    def tearDown(self):
+        default_cache.clear()
+        User.objects.all().delete()
+        self.settings.disable()
+
+    def test_unchanged_no_write(self):
+        with mock.patch('janrain.backends.User.objects.filter') as mfilter:
+            self.assertEqual(self.backend.authenticate(self.user_data), self.user)
+            self.assertFalse(mfilter.called, 'no write on repeat login')
+
+    def test_unchanged_skips_compare(self):
+        with mock.patch.object(JanrainBackend, 'find_user', return_value=mock.Mock(pk=self.user.pk)) as mfind:
+            self.assertEqual(self.backend.sync_user(mfind.return_value, JanrainUser(self.user_data)), [])
+
+    def test_changed_fields_written(self):
+        self.user_data['familyName'] = 'jones'
+        with mock.patch.object(User, 'save') as msave:
+            user = self.backend.authenticate(self.user_data)
+            self.assertFalse(msave.called, 'no full save')
+        self.assertEqual(user.last_name, 'jones')
+        stored = User.objects.get(pk=self.user.pk)
+        self.assertEqual((stored.first_name, stored.last_name), ('nate', 'jones'))
+        self.assertEqual(self.backend.sync_user(user, JanrainUser(self.user_data)), [])
+
+    def test_stale_digest_compares(self):
+        default_cache.clear()
+        self.assertEqual(self.backend.sync_user(self.user, JanrainUser(self.user_data)), [])
+        self.user_data['email'] = 'other@example.com'
+        self.assertEqual(self.backend.sync_user(self.user, JanrainUser(self.user_data)), ['email'])
+
+class TestIdentities(TestCase):
+    def setUp(self):
+        self.settings = override_settings(JANRAIN_USE_IDENTITIES=True)
+        self.settings.enable()
+        self.backend = JanrainBackend()
+        self.janrain_user = JanrainUser(dict(uuid='123456789'))
+
+    def tearDown(self):
+        JanrainIdentity.objects.all().delete()
+        User.objects.all().delete()
+        self.settings.disable()
+
+    def test_created_with_identity(self):
+        user = self.backend.authenticate(dict(uuid='123456789'))
+        identity = JanrainIdentity.objects.get(provider='capture', uuid='123456789')
+        self.assertEqual(identity.user, user)
+        self.assertEqual(self.backend.find_user(self.janrain_user), user)
+
+    def test_found_without_username(self):
+        user = User.objects.create(username='someone-else')
+        JanrainIdentity.objects.create(provider='capture', uuid='123456789', user=user)
+        self.assertEqual(self.backend.find_user(self.janrain_user), user)
+
+    def test_legacy_user_linked(self):
+        user = User.objects.create(username=self.janrain_user.hashed)
+        self.assertEqual(self.backend.find_user(self.janrain_user), user)
+        self.assertEqual(JanrainIdentity.objects.get(uuid='123456789').user, user)
@@ -0,0 +1,73 @@
+import mock
+import time
+from django.test.utils import override_settings
+from unittest2 import TestCase
+
+from janrain import api
+from janrain.api import JanrainClient
+from janrain.cache import EntityCache
+from janrain.tests.test_api import MockRequestsJsonResponse
+
+class TestEntityCache(TestCase):
+    def setUp(self):
+        self.cache = EntityCache(ttl=60, max_size=2)
+
+    def test_hit_and_miss(self):
+        self.assertEqual(self.cache.get('u1', 'user'), None)
+        self.cache.set('u1', 'user', dict(stat='ok'))
+        self.assertEqual(self.cache.get('u1', 'user'), dict(stat='ok'))
+        self.assertEqual(self.cache.stats(), dict(hits=1, misses=1, size=1))
+
+    def test_hit_is_a_copy(self):
+        self.cache.set('u1', 'user', dict(stat='ok', result=dict(uuid='u1')))
+        self.cache.get('u1', 'user')['result']['annotated'] = True
+        self.assertEqual(self.cache.get('u1', 'user'), dict(stat='ok', result=dict(uuid='u1')))
+
+    def test_ttl(self):
+        self.cache.set('u1', 'user', dict(stat='ok'))
+        with mock.patch('janrain.cache.time') as mtime:
+            mtime.time.return_value = time.time() + 61
+            self.assertEqual(self.cache.get('u1', 'user'), None, 'expired')
+
+    def test_lru(self):
+        self.cache.set('u1', 'user', 1)
+        self.cache.set('u2', 'user', 2)
+        self.cache.get('u1', 'user')
+        self.cache.set('u3', 'user', 3)
+        self.assertEqual(self.cache.get('u2', 'user'), None, 'least recently used evicted')
+        self.assertEqual(self.cache.get('u1', 'user'), 1)
+        self.assertEqual(self.cache.get('u3', 'user'), 3)
+
+    def test_django_backend(self):
+        cache = EntityCache(ttl=60, backend='locmem://')
+        cache.set('u1', 'user', dict(stat='ok'))
+        self.assertEqual(cache.backend.get('janrain:entity:user:u1'), dict(stat='ok'))
+        self.assertEqual(cache.get('u1', 'user'), dict(stat='ok'))
+        cache.invalidate('u1', 'user')
+        self.assertEqual(cache.get('u1', 'user'), None)
+
+class TestClientEntityCache(TestCase):
+    def setUp(self):
+        self.client = JanrainClient(client_id=1, client_secret=2, api_url='test_endpoint',
+            entity_cache=EntityCache())
+        self.reqs = mock.Mock()
+        self.reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(stat='ok', result={})))
+
+    def test_entity_cached(self):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.client.entity('u1', 'user')
+            self.client.entity('u1', 'user')
+            self.assertEqual(self.reqs.post.call_count, 1, 'second read served from cache')
+
+    def test_entity_update_invalidates(self):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.client.entity('u1', 'user')
+            self.client.entity_update('u1', 'user', dict(givenName='nate'))
+            self.client.entity('u1', 'user')
+            self.assertEqual(self.reqs.post.call_count, 3)
+
+    def test_registry_uses_settings(self):
+        with override_settings(JANRAIN_ENTITY_CACHE=dict(TTL=5)):
+            self.assertEqual(api.get_client(1, 2, 'test_endpoint').entity_cache.ttl, 5)
+        self.assertEqual(api.get_client(1, 2, 'test_endpoint').entity_cache, None)
+        api.clear_clients()
@@ -0,0 +1,74 @@
+import json
+import mock
+from django.test.utils import override_settings
+from unittest2 import TestCase
+
+from janrain import codec
+from janrain.api import JanrainClient
+from janrain.tests.test_api import MockRequestsJsonResponse
+
+class CountingCodec(object):
+    """ Stands in for a fast JSON module. """
+    def __init__(self):
+        self.calls = []
+
+    def loads(self, data):
+        self.calls.append(('loads', data))
+        return json.loads(data)
+
+    def dumps(self, obj):
+        self.calls.append(('dumps', obj))
+        return json.dumps(obj)
+
+counting_codec = CountingCodec()
+
+class EncodeDecodeCodec(object):
+    """ Like cjson, which has encode and decode instead. """
+    encode = staticmethod(json.dumps)
+    decode = staticmethod(json.loads)
+
+encode_decode_codec = EncodeDecodeCodec()
+
+class TestCodec(TestCase):
+    def setUp(self):
+        counting_codec.calls = []
+
+    def test_stdlib_default(self):
+        self.assertEqual(codec.get_codec().name, 'json')
+        self.assertEqual(codec.dumps(dict(a=[1, 2])), '{"a": [1, 2]}')
+        self.assertEqual(codec.loads('{"a": "\\u00e9"}'), dict(a=u'\xe9'))
+
+    def test_configured(self):
+        with override_settings(JANRAIN_JSON_CODEC='janrain.tests.test_codec.counting_codec'):
+            self.assertEqual(codec.loads('[1]'), [1])
+            self.assertEqual(counting_codec.calls, [('loads', '[1]')])
+        self.assertEqual(codec.get_codec().name, 'json')
+
+    def test_fallback(self):
+        with override_settings(JANRAIN_JSON_CODEC=('not_a_json_module',
+                'janrain.tests.test_codec.counting_codec')):
+            self.assertEqual(codec.get_codec().name, 'janrain.tests.test_codec.counting_codec')
+        with override_settings(JANRAIN_JSON_CODEC='not_a_json_module'):
+            self.assertEqual(codec.get_codec().name, 'json')
+
+    def test_without_loads_and_dumps(self):
+        with override_settings(JANRAIN_JSON_CODEC=('janrain.tests.test_codec.encode_decode_codec',
+                'janrain.tests.test_codec.counting_codec')):
+            self.assertEqual(codec.get_codec().name, 'janrain.tests.test_codec.counting_codec')
+        with override_settings(JANRAIN_JSON_CODEC='janrain.tests.test_codec.encode_decode_codec'):
+            self.assertEqual(codec.get_codec().name, 'json')
+            self.assertEqual(codec.loads('[1]'), [1])
+        self.assertRaises(ImportError, codec.import_codec, 'janrain.tests.test_codec.encode_decode_codec')
+
+    def test_client(self):
+        client = JanrainClient(client_id=1, client_secret=2, api_url='test_endpoint')
+        reqs = mock.Mock()
+        response = MockRequestsJsonResponse(dict(stat='ok'))
+        reqs.post = mock.Mock(return_value=response)
+        with override_settings(JANRAIN_JSON_CODEC='janrain.tests.test_codec.counting_codec'):
+            with mock.patch('janrain.api.get_session', return_value=reqs):
+                self.assertEqual(client.entity_update('u1', 'user', dict(givenName='Nate')), dict(stat='ok'))
+        self.assertEqual(counting_codec.calls, [
+            ('dumps', dict(givenName='Nate')),
+            ('loads', response.content),
+        ])
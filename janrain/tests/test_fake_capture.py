@@ -0,0 +1,27 @@
+from unittest2 import TestCase
+
+from janrain.api import JanrainClient
+from janrain.tests.fake_capture import FakeCaptureServer
+
+class TestFakeCapture(TestCase):
+    def setUp(self):
+        self.server = FakeCaptureServer(payload_size=16, entity_count=5).start()
+        self.client = JanrainClient('id', 'secret', self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_oauth_flow(self):
+        token = self.client.oauth_token('abc', 'http://example.com/')['access_token']
+        self.assertEqual(self.client.entity(access_token=token)['result']['uuid'], 'abc')
+
+    def test_entity_and_find(self):
+        self.assertEqual(self.client.entity('abc', 'user')['result']['aboutMe'], 'x' * 16)
+        records = list(self.client.iter_entities('user', page_size=2))
+        self.assertEqual([r['uuid'] for r in records], ['uuid-%d' % i for i in range(5)])
+
+    def test_cookies_not_replayed(self):
+        self.server.cookie = 'lb=node-1; Path=/'
+        self.client.oauth_token('abc', 'http://example.com/')
+        JanrainClient('other', 'secret', self.server.url).entity('def', 'user')
+        self.assertEqual(self.server.cookies_received, [None, None])
@@ -0,0 +1,98 @@
+import mock
+import socket
+from django.test.utils import override_settings
+from unittest2 import TestCase
+
+from janrain import instrumentation
+from janrain.api import JanrainClient
+from janrain.cache import EntityCache
+from janrain.instrumentation import Histogram, StatsdSink
+from janrain.signals import instrumented
+from janrain.tests.test_api import MockRequestsJsonResponse
+
+def broken_sink(name, data):
+    raise RuntimeError('broken sink')
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        self.settings = override_settings(JANRAIN_INSTRUMENTATION_SINKS=('janrain.instrumentation.histogram',))
+        self.settings.enable()
+        instrumentation.histogram.reset()
+        self.client = JanrainClient(client_id=1, client_secret=2, api_url='test_endpoint',
+            entity_cache=EntityCache())
+        self.reqs = mock.Mock()
+        self.reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(stat='ok')))
+
+    def tearDown(self):
+        self.settings.disable()
+        instrumentation.histogram.reset()
+
+    def test_api_call_and_cache(self):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.client.entity('u1', 'user')
+            self.client.entity('u1', 'user')
+        summary = instrumentation.histogram.summary()
+        self.assertEqual(summary['api_call:entity']['count'], 1)
+        self.assertEqual(summary['counters'], {
+            'api_call:entity:status:200': 1,
+            'cache:entity:hit': 1,
+            'cache:entity:miss': 1,
+        })
+
+    def test_failing_sinks(self):
+        def bad_receiver(sender, **kwargs):
+            raise RuntimeError('bad receiver')
+        instrumented.connect(bad_receiver)
+        try:
+            with override_settings(JANRAIN_INSTRUMENTATION_SINKS=(
+                    'janrain.instrumentation.SignalSink',
+                    'janrain.tests.test_instrumentation.broken_sink',
+                    'janrain.instrumentation.histogram')):
+                with mock.patch('janrain.api.get_session', return_value=self.reqs):
+                    self.assertEqual(self.client.entity('u1', 'user'), dict(stat='ok'))
+        finally:
+            instrumented.disconnect(bad_receiver)
+        self.assertEqual(instrumentation.histogram.summary()['api_call:entity']['count'], 1,
+            'later sinks still run')
+
+    def test_disabled(self):
+        with override_settings(JANRAIN_INSTRUMENTATION_SINKS=()):
+            self.assertEqual(instrumentation.sinks, [])
+            with mock.patch('janrain.api.get_session', return_value=self.reqs):
+                self.client.entity('u1', 'user')
+        self.assertEqual(instrumentation.histogram.summary(), dict(counters={}))
+
+    def test_signal_sink(self):
+        received = []
+        def handler(sender, name, data, **kwargs):
+            received.append((name, data))
+        instrumented.connect(handler)
+        try:
+            instrumentation.SignalSink()('login', dict(view='login', duration=0.1))
+        finally:
+            instrumented.disconnect(handler)
+        self.assertEqual(received, [('login', dict(view='login', duration=0.1))])
+
+class TestHistogram(TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+        for ms in range(1, 101):
+            histogram.observe('api_call:entity', ms / 1000.0)
+        self.assertEqual(histogram.percentile('api_call:entity', 50), 50)
+        self.assertEqual(histogram.percentile('api_call:entity', 99), 100)
+        self.assertEqual(histogram.percentile('api_call:other', 99), None)
+
+class TestStatsdSink(TestCase):
+    def test_sends_udp(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(1)
+        sink = StatsdSink(host='127.0.0.1', port=server.getsockname()[1])
+        sink('api_call', dict(path='oauth/token', method='post', status=200, duration=0.25,
+            size=10, attempt=0, error=None))
+        self.assertEqual(server.recv(1024).split('\n'), [
+            'janrain.api.oauth_token.time:250|ms',
+            'janrain.api.oauth_token.status.200:1|c',
+            'janrain.api.oauth_token.size:10|h',
+        ])
+        server.close()
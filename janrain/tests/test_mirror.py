@@ -0,0 +1,146 @@
+import mock
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test.utils import override_settings
+from django.utils import timezone
+from unittest2 import TestCase
+
+from janrain import api, codec
+from janrain.backends import JanrainBackend
+from janrain.mirror import ProfileMirror, profile_mirror_from_settings
+from janrain.models import MirroredEntity
+from janrain.provisioning import import_users
+from janrain.tests.test_api import MockRequestsJsonResponse
+
+ENTITY = dict(uuid='u1', givenName='Nate', familyName='Aune', email='Nate@Example.com',
+    primaryAddress=dict(city='Paris'))
+
+class TestProfileMirror(TestCase):
+    def setUp(self):
+        self.mirror = ProfileMirror(max_age=60)
+
+    def tearDown(self):
+        MirroredEntity.objects.all().delete()
+
+    def test_store_and_get(self):
+        self.assertEqual(self.mirror.get('u1', 'user'), None)
+        self.mirror.store(ENTITY)
+        self.assertEqual(self.mirror.get('u1', 'user'), dict(stat='ok', result=ENTITY))
+        self.assertEqual(self.mirror.get('u1', 'other'), None, 'keyed by type_name')
+        self.assertEqual(self.mirror.stats(), dict(hits=1, misses=2, size=1))
+
+        row = MirroredEntity.objects.get(uuid='u1')
+        self.assertEqual(row.email, 'nate@example.com')
+        self.assertEqual(row.name, 'Nate Aune')
+        self.assertEqual(codec.loads(row.data), ENTITY, 'serialized with the codec')
+
+    def test_stale(self):
+        self.mirror.store(ENTITY)
+        MirroredEntity.objects.update(synced_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(self.mirror.get('u1', 'user'), None)
+        self.mirror.store(ENTITY)
+        self.assertNotEqual(self.mirror.get('u1', 'user'), None, 'stored again, fresh')
+        self.assertEqual(MirroredEntity.objects.count(), 1)
+
+    def test_update_merges(self):
+        self.mirror.store(ENTITY)
+        self.mirror.update('u1', 'user', dict(email='nate@aune.net', primaryAddress=dict(zip='75001')))
+        result = self.mirror.get('u1', 'user')['result']
+        self.assertEqual(result['primaryAddress'], dict(city='Paris', zip='75001'))
+        self.assertEqual(self.mirror.find_by_email('NATE@aune.net'), [result])
+        self.assertEqual(self.mirror.find_by_email('nate@example.com'), [])
+
+        self.mirror.update('u2', 'user', dict(email='x@example.com'))
+        self.assertEqual(MirroredEntity.objects.count(), 1, 'nothing to merge into')
+
+    def test_concurrent_create(self):
+        def other_login_first(model, **values):
+            model.objects.create(**dict(values, data='{}'))
+            return False
+        with mock.patch('janrain.mirror.create_unless_exists', side_effect=other_login_first):
+            self.mirror.store(ENTITY)
+        self.assertEqual(self.mirror.get('u1', 'user')['result'], ENTITY)
+        self.assertEqual(MirroredEntity.objects.count(), 1)
+
+    def test_store_many(self):
+        self.mirror.store(ENTITY)
+        entities = [dict(ENTITY, givenName='Nathan'), dict(uuid='u2'), dict(givenName='no uuid')]
+        self.assertEqual(self.mirror.store_many(entities), 2)
+        self.assertEqual(MirroredEntity.objects.get(uuid='u1').name, 'Nathan Aune')
+        self.assertEqual(MirroredEntity.objects.count(), 2)
+
+class TestMirrorSettings(TestCase):
+    def setUp(self):
+        self.settings = override_settings(JANRAIN_PROFILE_MIRROR=dict(MAX_AGE=60))
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        api.clear_clients()
+        cache.clear()
+        MirroredEntity.objects.all().delete()
+        User.objects.all().delete()
+
+    def test_client_reads_through_mirror(self):
+        client = api.get_client(1, 2, 'test_endpoint')
+        self.assertTrue(isinstance(client.entity_cache, ProfileMirror))
+        reqs = mock.Mock()
+        reqs.post = mock.Mock(return_value=MockRequestsJsonResponse(dict(stat='ok', result=ENTITY)))
+        with mock.patch('janrain.api.get_session', return_value=reqs):
+            client.entity('u1', 'user')
+            self.assertEqual(client.entity('u1', 'user')['result'], ENTITY)
+            self.assertEqual(reqs.post.call_count, 1, 'second read served from the mirror')
+
+            client.entity_update('u1', 'user', dict(givenName='Nathan'))
+            self.assertEqual(client.entity('u1', 'user')['result']['givenName'], 'Nathan')
+            self.assertEqual(reqs.post.call_count, 2)
+
+    def test_authenticate_mirrors(self):
+        JanrainBackend().authenticate(ENTITY)
+        self.assertEqual(MirroredEntity.objects.get(uuid='u1').email, 'nate@example.com')
+        JanrainBackend().authenticate(dict(profile=dict(identifier='engage-1')))
+        self.assertEqual(MirroredEntity.objects.count(), 1, 'Engage profiles are not entities')
+
+    def test_unchanged_login_not_written(self):
+        JanrainBackend().authenticate(ENTITY)
+        with mock.patch('janrain.mirror.ProfileMirror._write') as write:
+            JanrainBackend().authenticate(dict(ENTITY))
+            self.assertFalse(write.called, 'unchanged')
+            JanrainBackend().authenticate(dict(ENTITY, givenName='Nathan'))
+            self.assertEqual(write.call_count, 1)
+
+    def test_invalidated_login_written(self):
+        JanrainBackend().authenticate(ENTITY)
+        profile_mirror_from_settings().invalidate('u1', 'user')
+        JanrainBackend().authenticate(ENTITY)
+        self.assertNotEqual(profile_mirror_from_settings().get('u1', 'user'), None, 'fresh again')
+
+    def test_type_name(self):
+        with override_settings(JANRAIN_PROFILE_MIRROR=dict(TYPE_NAME='member')):
+            JanrainBackend().authenticate(ENTITY)
+            self.assertEqual(MirroredEntity.objects.get(uuid='u1').type_name, 'member')
+            self.assertEqual(len(profile_mirror_from_settings().find_by_email('nate@example.com')), 1)
+
+    def test_import_mirrors(self):
+        stats = import_users([ENTITY, dict(uuid='u2')])
+        self.assertEqual(stats['mirrored'], 2)
+        self.assertEqual(MirroredEntity.objects.count(), 2)
+
+class TestMirrorInvalidation(TestCase):
+    def tearDown(self):
+        MirroredEntity.objects.all().delete()
+
+    def test_invalidate_many(self):
+        mirror = ProfileMirror()
+        mirror.store_many([dict(uuid='u1'), dict(uuid='u2'), dict(uuid='u3')])
+        mirror.invalidate_many(set(['u1', 'u2']), 'user')
+        self.assertEqual(mirror.get('u1', 'user'), None, 'stale')
+        self.assertNotEqual(mirror.get('u3', 'user'), None)
+        self.assertEqual(MirroredEntity.objects.count(), 3, 'rows kept')
+
+    def test_find_by_email_after_invalidation(self):
+        mirror = ProfileMirror()
+        mirror.store(ENTITY)
+        mirror.invalidate_many(['u1'], 'user')
+        self.assertEqual(mirror.find_by_email('nate@example.com'), [ENTITY])
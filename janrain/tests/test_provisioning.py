@@ -0,0 +1,47 @@
+import os
+import tempfile
+from django.contrib.auth.models import User
+from unittest2 import TestCase
+
+from janrain.backends import JanrainUser
+from janrain.models import JanrainIdentity
+from janrain.provisioning import Checkpoint, import_users
+
+class TestImportUsers(TestCase):
+    def setUp(self):
+        self.records = [dict(uuid=str(i), givenName='user%d' % i) for i in range(5)]
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        JanrainIdentity.objects.all().delete()
+        User.objects.all().delete()
+        os.unlink(self.path)
+
+    def test_import_creates_missing(self):
+        User.objects.create(username=JanrainUser(self.records[0]).hashed)
+        stats = import_users(self.records + [dict(givenName='nouuid')], chunk_size=2)
+        self.assertEqual(stats['processed'], 6)
+        self.assertEqual(stats['created'], 4)
+        self.assertEqual(stats['existing'], 1)
+        self.assertEqual(stats['invalid'], 1)
+        self.assertEqual(User.objects.count(), 5)
+        user = User.objects.get(username=JanrainUser(self.records[3]).hashed)
+        self.assertEqual(user.first_name, 'user3')
+        self.assertFalse(user.has_usable_password())
+
+    def test_import_checkpoint(self):
+        checkpoint = Checkpoint(self.path)
+        import_users(self.records[2:], chunk_size=2, start=2, checkpoint=checkpoint)
+        self.assertEqual(checkpoint.load(), 5)
+
+    def test_link_only(self):
+        for record in self.records[:3]:
+            User.objects.create(username=JanrainUser(record).hashed)
+        stats = import_users(self.records, chunk_size=2, link_only=True)
+        self.assertEqual(stats['created'], 0)
+        self.assertEqual(stats['linked'], 3)
+        self.assertEqual(User.objects.count(), 3)
+        identity = JanrainIdentity.objects.get(uuid='1')
+        self.assertEqual(identity.user.username, JanrainUser(self.records[1]).hashed)
+        self.assertEqual(import_users(self.records, link_only=True)['linked'], 0, 'already linked')
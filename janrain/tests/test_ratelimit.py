@@ -0,0 +1,167 @@
+import mock
+import threading
+import time
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
+from unittest2 import TestCase
+
+from janrain import api
+from janrain.api import JanrainClient
+from janrain.ratelimit import (BATCH, INTERACTIVE, CacheTokenBucket, RateLimiter, TokenBucket,
+    rate_limiter_from_settings)
+from janrain.tests.test_api import MockRequestsJsonResponse
+
+class ManualBucket(object):
+    """ Hands out only the tokens a test gives it. """
+    def __init__(self):
+        self.tokens = 0
+        self.lock = threading.Lock()
+
+    def take(self, reserve=0):
+        with self.lock:
+            if self.tokens > reserve:
+                self.tokens -= 1
+                return 0
+            return 0.005
+
+class TestBuckets(TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        self.assertAlmostEqual(bucket.take(), 0.1, places=2)
+        with mock.patch('janrain.ratelimit.time') as mtime:
+            mtime.time.return_value = bucket.updated + 0.1
+            self.assertEqual(bucket.take(), 0, 'refilled')
+
+    def test_token_bucket_reserve(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertEqual(bucket.take(reserve=1), 0)
+        self.assertTrue(bucket.take(reserve=1) > 0, 'last token held back')
+        self.assertEqual(bucket.take(), 0)
+
+    def test_cache_bucket(self):
+        buckets = [CacheTokenBucket(rate=3, alias='locmem://', key='test') for i in range(2)]
+        buckets[1].cache = buckets[0].cache
+        with mock.patch('janrain.ratelimit.time') as mtime:
+            mtime.time.return_value = 1000.25
+            self.assertEqual(buckets[0].take(), 0)
+            self.assertEqual(buckets[1].take(reserve=1), 0)
+            self.assertEqual(buckets[0].take(reserve=1), 0.75, 'shared count, reserve held back')
+            self.assertEqual(buckets[1].take(), 0)
+            self.assertEqual(buckets[0].take(), 0.75)
+            mtime.time.return_value = 1001.0
+            self.assertEqual(buckets[0].take(), 0, 'next window')
+
+    def test_cache_bucket_failing(self):
+        bucket = CacheTokenBucket(rate=2, alias='locmem://', key='test-failing')
+        bucket.cache = mock.Mock()
+        bucket.cache.incr.side_effect = IOError('cache down')
+        self.assertEqual(bucket.take(), 0, 'limited in process instead')
+        self.assertEqual(bucket.take(), 0)
+        self.assertTrue(bucket.take() > 0)
+
+    def test_cache_bucket_evicted(self):
+        bucket = CacheTokenBucket(rate=1, alias='locmem://', key='test-evicted')
+        bucket.cache = mock.Mock()
+        bucket.cache.incr.return_value = 2
+        bucket.cache.decr.side_effect = ValueError('Key not found')
+        self.assertTrue(bucket.take() > 0)
+        self.assertEqual(bucket.fallback.tokens, 1, 'not a cache failure')
+
+class TestRateLimiter(TestCase):
+    def test_interactive_first(self):
+        bucket = ManualBucket()
+        limiter = RateLimiter(bucket)
+        order = []
+
+        def call(priority):
+            limiter.acquire(priority)
+            order.append(priority)
+
+        threads = [threading.Thread(target=call, args=(BATCH,))]
+        threads[0].start()
+        while not limiter.waiting[BATCH]:
+            time.sleep(0.001)
+        threads.append(threading.Thread(target=call, args=(INTERACTIVE,)))
+        threads[1].start()
+        while not limiter.waiting[INTERACTIVE]:
+            time.sleep(0.001)
+
+        stats = limiter.stats()
+        self.assertEqual((stats[BATCH]['waiting'], stats[INTERACTIVE]['waiting']), (1, 1))
+        bucket.tokens = 1
+        while not order:
+            time.sleep(0.001)
+        bucket.tokens = 1
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [INTERACTIVE, BATCH])
+
+        stats = limiter.stats()
+        self.assertEqual(stats[BATCH]['acquired'], 1)
+        self.assertEqual(stats[INTERACTIVE]['waiting'], 0)
+        self.assertTrue(stats[BATCH]['max_wait'] >= stats[INTERACTIVE]['max_wait'] > 0)
+
+    def test_bucket_taken_unlocked(self):
+        limiter = RateLimiter(mock.Mock())
+        locked = []
+        def take(reserve):
+            if limiter.cond.acquire(False):
+                limiter.cond.release()
+            else:
+                locked.append(reserve)
+            return 0
+        limiter.bucket.take.side_effect = take
+        limiter.acquire(INTERACTIVE)
+        limiter.acquire(BATCH)
+        self.assertEqual(locked, [])
+        self.assertEqual(limiter.stats()[BATCH]['acquired'], 1)
+
+    def test_reserve(self):
+        bucket = ManualBucket()
+        limiter = RateLimiter(bucket, reserve=1)
+        bucket.tokens = 1
+        limiter.acquire(INTERACTIVE)
+        self.assertEqual(bucket.tokens, 0, 'interactive calls may use the reserve')
+
+        bucket.tokens = 1
+        thread = threading.Thread(target=limiter.acquire, args=(BATCH,))
+        thread.start()
+        time.sleep(0.02)
+        self.assertEqual(limiter.waiting[BATCH], 1, 'batch calls may not')
+        bucket.tokens = 2
+        thread.join()
+        self.assertEqual(bucket.tokens, 1)
+
+class TestClientRateLimit(TestCase):
+    def setUp(self):
+        self.limiter = mock.Mock()
+        self.client = JanrainClient(client_id=1, client_secret=2, api_url='test_endpoint',
+            rate_limiter=self.limiter)
+        self.reqs = mock.Mock()
+        self.reqs.post = self.reqs.get = mock.Mock(return_value=MockRequestsJsonResponse(dict(stat='ok')))
+
+    def test_priorities(self):
+        with mock.patch('janrain.api.get_session', return_value=self.reqs):
+            self.client.oauth_token('code', 'uri')
+            self.client.entity(access_token='token')
+            self.client.entity('u1', 'user')
+            self.client.entity_update('u1', 'user', {})
+        self.assertEqual([args for args, kwargs in self.limiter.acquire.call_args_list],
+            [(INTERACTIVE,), (INTERACTIVE,), (BATCH,), (BATCH,)])
+
+    def test_registry_uses_settings(self):
+        with override_settings(JANRAIN_RATE_LIMIT=dict(RATE=5, RESERVE=1)):
+            limiter = api.get_client(1, 2, 'test_endpoint').rate_limiter
+            self.assertEqual((limiter.bucket.rate, limiter.reserve), (5, 1))
+        self.assertEqual(api.get_client(1, 2, 'test_endpoint').rate_limiter, None)
+        api.clear_clients()
+
+    def test_reserve_too_large(self):
+        for conf in (dict(RATE=5, RESERVE=5), dict(RATE=5, BURST=10, RESERVE=9.5),
+                dict(RATE=5, RESERVE=5, CACHE='locmem://')):
+            with override_settings(JANRAIN_RATE_LIMIT=conf):
+                self.assertRaises(ImproperlyConfigured, rate_limiter_from_settings, 'test')
+        with override_settings(JANRAIN_RATE_LIMIT=dict(RATE=5, BURST=10, RESERVE=9)):
+            self.assertEqual(rate_limiter_from_settings('test').reserve, 9)
@@ -0,0 +1,38 @@
+from django.template import Context, Template, TemplateSyntaxError
+from django.test.utils import override_settings
+from unittest2 import TestCase
+
+class TestJanrainCaptureTags(TestCase):
+    def setUp(self):
+        self.settings = override_settings(JANRAIN_CAPTURE_APP_ID='app', JANRAIN_CAPTURE_CLIENT_ID='client')
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def test_literal_domain(self):
+        html = Template('{% load janrain_capture %}{% janrain_capture_signin "example.com" %}').render(Context())
+        self.assertTrue('src="https://app.janraincapture.com/oauth/signin?response_type=code'
+            '&redirect_uri=http://example.com/janrain/oauth_redirect&client_id=client'
+            '&xdreceiver=http://example.com/janrain/xdcomm.html"' in html)
+
+    def test_variable_domain_per_render(self):
+        t = Template('{% load janrain_capture %}{% janrain_capture_register domain %}')
+        first = t.render(Context(dict(domain='one.example.com')))
+        second = t.render(Context(dict(domain='two.example.com')))
+        self.assertTrue('/oauth/register?' in first)
+        self.assertTrue('http://one.example.com/janrain/oauth_redirect' in first)
+        self.assertTrue('http://two.example.com/janrain/oauth_redirect' in second, 'domain not stuck on the node')
+        self.assertEqual(t.render(Context(dict(domain='one.example.com'))), first)
+
+    def test_lazy(self):
+        html = Template('{% load janrain_capture %}{% janrain_capture_signin "example.com" lazy %}').render(Context())
+        self.assertFalse('<iframe' in html, 'iframe deferred')
+        self.assertTrue('<link rel="preconnect" href="https://app.janraincapture.com">' in html)
+        self.assertTrue('data-janrain-capture-src="https://app.janraincapture.com/oauth/signin?response_type=code'
+            '&redirect_uri=http://example.com/janrain/oauth_redirect&client_id=client'
+            '&xdreceiver=http://example.com/janrain/xdcomm.html"' in html)
+
+    def test_bad_option(self):
+        self.assertRaises(TemplateSyntaxError, Template,
+            '{% load janrain_capture %}{% janrain_capture_signin "example.com" eager %}')
@@ -0,0 +1,61 @@
+import mock
+import time
+from django.core.cache import get_cache
+from unittest2 import TestCase
+
+from janrain.api import APIException
+from janrain.tokens import TokenStore
+
+class TestTokenStore(TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.cache = get_cache('locmem://')
+        self.store = TokenStore(self.client, self.cache, margin=60)
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_save_and_get(self):
+        self.store.save(1, dict(access_token='a', refresh_token='r', expires_in=3600))
+        self.assertEqual(self.store.get(1), 'a')
+        self.assertFalse(self.client.refresh_token.called)
+        self.assertEqual(self.store.get(2), None)
+
+    def test_expired_refreshes(self):
+        self.store.save(1, dict(access_token='a', refresh_token='r', expires_in=0))
+        self.client.refresh_token.return_value = dict(stat='ok', access_token='b', refresh_token='r2', expires_in=3600)
+        self.assertEqual(self.store.get(1), 'b')
+        self.client.refresh_token.assert_called_with('r')
+        self.assertEqual(self.store.get(1), 'b')
+
+    def test_refresh_keeps_refresh_token(self):
+        self.store.save(1, dict(access_token='a', refresh_token='r', expires_in=0))
+        self.client.refresh_token.return_value = dict(stat='ok', access_token='b', expires_in=0)
+        self.assertEqual(self.store.get(1), 'b')
+        self.assertEqual(self.cache.get(self.store.key(1))['refresh_token'], 'r')
+        self.client.refresh_token.return_value = dict(stat='ok', access_token='c', expires_in=3600)
+        self.assertEqual(self.store.get(1), 'c', 'still refreshable after the first refresh')
+        self.assertEqual(self.client.refresh_token.call_count, 2)
+        self.client.refresh_token.assert_called_with('r')
+
+    def test_expiring_refreshes_in_background(self):
+        self.store.save(1, dict(access_token='a', refresh_token='r', expires_in=30))
+        self.client.refresh_token.return_value = dict(stat='ok', access_token='b', expires_in=3600)
+        self.assertEqual(self.store.get(1), 'a', 'current token handed out meanwhile')
+        for i in range(50):
+            if self.cache.get(self.store.key(1))['access_token'] == 'b':
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.store.get(1), 'b')
+        self.assertEqual(self.client.refresh_token.call_count, 1)
+
+    def test_refresh_rejected(self):
+        self.store.save(1, dict(access_token='a', refresh_token='r', expires_in=0))
+        self.client.refresh_token.return_value = dict(stat='error', error='invalid_grant')
+        self.assertEqual(self.store.get(1), None)
+        self.assertEqual(self.cache.get(self.store.key(1)), None, 'dead token forgotten')
+
+    def test_refresh_unavailable(self):
+        self.store.save(1, dict(access_token='a', refresh_token='r', expires_in=0))
+        self.client.refresh_token.side_effect = APIException('oauth/token', {})
+        self.assertEqual(self.store.get(1), None)
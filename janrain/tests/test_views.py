@@ -0,0 +1,128 @@
+import json
+import mock
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.cache import SessionStore
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.http import http_date
+from unittest2 import TestCase
+
+from janrain.views import JanrainLoginView, JanrainLogoutView, JanrainReturnView, JanrainWebhookView, JanrainXDCommView
+from janrain.webhooks import ChangeBatcher, signature
+
+class TestStaticTemplateViews(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = JanrainXDCommView.as_view()
+
+    def test_served_with_validators(self):
+        response = self.view(self.factory.get('/janrain/xdcomm.html'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('xdcomm.js' in response.content)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertTrue('max-age=' in response['Cache-Control'])
+
+    def test_if_none_match(self):
+        etag = self.view(self.factory.get('/janrain/xdcomm.html'))['ETag']
+        response = self.view(self.factory.get('/janrain/xdcomm.html', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        response = self.view(self.factory.get('/janrain/xdcomm.html', HTTP_IF_NONE_MATCH='"stale"'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        last_modified = self.view(self.factory.get('/janrain/xdcomm.html'))['Last-Modified']
+        response = self.view(self.factory.get('/janrain/xdcomm.html', HTTP_IF_MODIFIED_SINCE=last_modified))
+        self.assertEqual(response.status_code, 304)
+        response = self.view(self.factory.get('/janrain/xdcomm.html', HTTP_IF_MODIFIED_SINCE=http_date(0)))
+        self.assertEqual(response.status_code, 200)
+
+    def test_templates_kept_apart(self):
+        response = JanrainReturnView.as_view()(self.factory.get('/janrain/return.html'))
+        self.assertTrue('Thanks for logging in' in response.content)
+
+class TestWebhookView(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = JanrainWebhookView.as_view()
+        self.settings = override_settings(JANRAIN_WEBHOOK_SECRET='sekrit')
+        self.settings.enable()
+        self.batcher = ChangeBatcher(interval=60)
+        self.patch = mock.patch('janrain.views.get_batcher', return_value=self.batcher)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.settings.disable()
+
+    def post(self, body, secret='sekrit'):
+        return self.view(self.factory.post('/janrain/webhook', body,
+            content_type='application/json',
+            HTTP_X_JANRAIN_SIGNATURE=signature(secret, body)))
+
+    def test_batched(self):
+        body = json.dumps([dict(uuid='u1'), dict(uuid='u1'), dict(uuid='u2', entityType='user'),
+            dict(uuid='u3', entityType='other')])
+        response = self.post(body)
+        self.assertEqual(response.status_code, 204)
+        self.post(json.dumps(dict(events=[dict(uuid='u2')])))
+        self.assertEqual(self.batcher.pending, dict(user=set(['u1', 'u2']), other=set(['u3'])))
+
+    def test_bad_signature(self):
+        self.assertEqual(self.post('[]', secret='wrong').status_code, 403)
+        response = self.view(self.factory.post('/janrain/webhook', '[]', content_type='application/json'))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.batcher.pending, {})
+
+    def test_bad_body(self):
+        self.assertEqual(self.post('{').status_code, 400)
+        self.assertEqual(self.post('[{"entityType": "user"}]').status_code, 400)
+
+class TestLogoutView(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = JanrainLogoutView.as_view()
+
+    def request(self, user):
+        request = self.factory.get('/janrain/logout/')
+        request.session = SessionStore()
+        request.user = user
+        return request
+
+    def test_without_capture_settings(self):
+        self.assertFalse(hasattr(settings, 'JANRAIN_CAPTURE_CLIENT_ID'))
+        response = self.view(self.request(AnonymousUser()))
+        self.assertEqual(response.status_code, 302)
+
+    def test_forgets_tokens(self):
+        user = User(pk=1, username='someone')
+        with override_settings(JANRAIN_TOKEN_CACHE=dict(BACKEND='locmem://')):
+            with mock.patch('janrain.tokens.TokenStore.forget') as forget:
+                response = self.view(self.request(user))
+        self.assertEqual(response.status_code, 302)
+        forget.assert_called_with(1)
+
+class TestEngageLoginView(TestCase):
+    def setUp(self):
+        self.settings = override_settings(
+            AUTHENTICATION_BACKENDS=('janrain.backends.JanrainBackend',),
+            JANRAIN_API_KEY='key')
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        User.objects.all().delete()
+
+    def test_login(self):
+        request = RequestFactory().post('/janrain/login/', dict(token='t'))
+        request.session = SessionStore()
+        auth_info = dict(stat='ok', profile=dict(identifier='http://example.com/nate',
+            name=dict(givenName='Nate', familyName='Aune'), displayName='nate'))
+        with mock.patch('janrain.views.engage_client') as engage_client:
+            engage_client.return_value.auth_info.return_value = auth_info
+            response = JanrainLoginView.as_view()(request)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(request.user.first_name, 'Nate')
+        self.assertEqual(request.session['_auth_user_id'], request.user.pk)
@@ -0,0 +1,75 @@
+from django.test.utils import override_settings
+from unittest2 import TestCase
+
+from janrain import api
+from janrain.signals import entity_changed
+from janrain.views import capture_client
+from janrain.webhooks import ChangeBatcher, verify, signature
+
+class TestChangeBatcher(TestCase):
+    def setUp(self):
+        self.sent = []
+        entity_changed.connect(self.receiver)
+
+    def tearDown(self):
+        entity_changed.disconnect(self.receiver)
+
+    def receiver(self, sender, type_name, uuids, **kwargs):
+        self.sent.append((type_name, uuids))
+
+    def test_deduplicated(self):
+        batcher = ChangeBatcher(interval=60)
+        for i in range(1000):
+            batcher.add(dict(user=['u%d' % (i % 10)]))
+        self.assertEqual(self.sent, [])
+        self.assertEqual(batcher.flush(), 10)
+        self.assertEqual(self.sent, [('user', set('u%d' % i for i in range(10)))])
+        self.assertEqual(batcher.flush(), 0)
+
+    def test_immediate(self):
+        ChangeBatcher(interval=0).add(dict(user=['u1']))
+        self.assertEqual(self.sent, [('user', set(['u1']))])
+
+    def test_failing_receiver(self):
+        def broken(sender, **kwargs):
+            raise RuntimeError('database down')
+        entity_changed.connect(broken)
+        try:
+            batcher = ChangeBatcher(interval=60)
+            batcher.add(dict(user=['u1'], group=['g1']))
+            self.assertEqual(batcher.flush(), 2)
+        finally:
+            entity_changed.disconnect(broken)
+        self.assertEqual(sorted(self.sent), [('group', set(['g1'])), ('user', set(['u1']))])
+
+    def test_worker(self):
+        batcher = ChangeBatcher(interval=0.01)
+        batcher.start()
+        batcher.add(dict(user=['u1']))
+        batcher.stop(flush=False)
+        batcher.flush()
+        self.assertEqual(self.sent, [('user', set(['u1']))])
+
+    def test_verify(self):
+        self.assertTrue(verify('sekrit', 'body', signature('sekrit', 'body')))
+        self.assertFalse(verify('sekrit', 'body', signature('sekrit', 'other')))
+        self.assertFalse(verify(None, 'body', signature('', 'body')), 'no secret, nothing verifies')
+
+class TestInvalidation(TestCase):
+    def setUp(self):
+        self.settings = override_settings(JANRAIN_ENTITY_CACHE=dict(TTL=60),
+            JANRAIN_CAPTURE_CLIENT_ID=1, JANRAIN_CAPTURE_CLIENT_SECRET=2,
+            JANRAIN_CAPTURE_API_URL='test_endpoint')
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        api.clear_clients()
+
+    def test_entity_cache_invalidated(self):
+        cache = capture_client().entity_cache
+        cache.set('u1', 'user', dict(stat='ok'))
+        cache.set('u2', 'user', dict(stat='ok'))
+        ChangeBatcher(interval=0).add(dict(user=['u1']))
+        self.assertEqual(cache.get('u1', 'user'), None)
+        self.assertEqual(cache.get('u2', 'user'), dict(stat='ok'))
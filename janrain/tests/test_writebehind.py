@@ -0,0 +1,219 @@
+import mock
+import time
+from datetime import timedelta
+from django.utils import timezone
+from unittest2 import TestCase
+
+from janrain.models import PendingEntityUpdate
+from janrain.writebehind import (BackendUnavailable, CacheBackend, DatabaseBackend, MemoryBackend,
+    WriteBehindQueue, create_unless_exists, entity_update_failed, merge)
+
+class TestMerge(TestCase):
+    def test_merge(self):
+        self.assertEqual(
+            merge(dict(a=1, b=dict(c=1, d=1)), dict(b=dict(d=2), e=3)),
+            dict(a=1, b=dict(c=1, d=2), e=3)
+        )
+
+class BackendTests(object):
+    def test_put_merges(self):
+        self.backend.put('u1', 'user', dict(givenName='nate'))
+        self.backend.put('u2', 'user', dict(givenName='mike'))
+        self.backend.put('u1', 'user', dict(familyName='smith'))
+        self.assertEqual(self.backend.count(), 2)
+        self.assertEqual(sorted(self.backend.take(10)), [
+            ('u1', 'user', dict(givenName='nate', familyName='smith'), 0),
+            ('u2', 'user', dict(givenName='mike'), 0),
+        ])
+        self.assertEqual(self.backend.count(), 0)
+
+    def test_take_limit(self):
+        for i in range(3):
+            self.backend.put('u%d' % i, 'user', dict(n=i))
+        self.assertEqual(len(self.backend.take(2)), 2)
+        self.assertEqual(self.backend.count(), 1)
+
+    def test_retry_keeps_newer(self):
+        self.backend.put('u1', 'user', dict(givenName='nate', familyName='smith'))
+        taken = self.backend.take(10)
+        self.backend.put('u1', 'user', dict(givenName='nathaniel'))
+        self.backend.retry('u1', 'user', taken[0][2], 1, 'boom')
+        self.assertEqual(self.backend.take(10), [
+            ('u1', 'user', dict(givenName='nathaniel', familyName='smith'), 1),
+        ])
+
+class TestMemoryBackend(BackendTests, TestCase):
+    def setUp(self):
+        self.backend = MemoryBackend()
+
+class ClaimTests(object):
+    """ For backends that keep updates until done. """
+    def test_kept_until_done(self):
+        self.backend.put('u1', 'user', dict(givenName='nate'))
+        self.backend.put('u2', 'user', dict(givenName='mike'))
+        self.assertEqual(len(self.backend.take(10)), 2)
+        self.assertEqual(self.backend.take(10), [], 'claimed')
+        self.backend.done('u1', 'user')
+        self.assertEqual(self.pending(), ['u2'])
+
+    def test_lease_expires(self):
+        self.backend.put('u1', 'user', dict(givenName='nate'))
+        self.backend.take(10)
+        # the flushing process died before done
+        restarted = self.restarted(lease=60)
+        self.assertEqual(restarted.take(10), [])
+        self.age_claims(61)
+        self.assertEqual(restarted.take(10), [('u1', 'user', dict(givenName='nate'), 0)])
+
+    def test_put_while_claimed(self):
+        self.backend.put('u1', 'user', dict(givenName='nate'))
+        self.backend.take(10)
+        self.backend.put('u1', 'user', dict(familyName='smith'))
+        self.backend.done('u1', 'user')
+        self.assertEqual(self.backend.take(10), [
+            ('u1', 'user', dict(givenName='nate', familyName='smith'), 0),
+        ], 'newer update still to send')
+
+class TestDatabaseBackend(BackendTests, ClaimTests, TestCase):
+    def setUp(self):
+        self.backend = DatabaseBackend()
+
+    def tearDown(self):
+        PendingEntityUpdate.objects.all().delete()
+
+    def pending(self):
+        return list(PendingEntityUpdate.objects.values_list('uuid', flat=True))
+
+    def restarted(self, lease):
+        return DatabaseBackend(lease=lease)
+
+    def age_claims(self, seconds):
+        PendingEntityUpdate.objects.update(claimed_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_put_uses_callers_transaction(self):
+        with mock.patch('janrain.writebehind.transaction.commit_on_success') as commit_on_success:
+            self.backend.put('u1', 'user', dict(givenName='nate'))
+            self.backend.put('u1', 'user', dict(familyName='smith'))
+        self.assertFalse(commit_on_success.called)
+
+class TestCacheBackend(BackendTests, ClaimTests, TestCase):
+    def setUp(self):
+        self.backend = CacheBackend('locmem://', shards=4)
+        self.now = time.time()
+        self.clock = mock.patch('janrain.writebehind.time.time', lambda: self.now)
+        self.clock.start()
+
+    def tearDown(self):
+        self.clock.stop()
+        self.backend.cache.clear()
+
+    def pending(self):
+        return [uuid for shard in range(self.backend.shards)
+            for type_name, uuid in self.backend.cache.get(self.backend.index_key(shard)) or []]
+
+    def restarted(self, lease):
+        return CacheBackend('locmem://', shards=4, lease=lease)
+
+    def age_claims(self, seconds):
+        self.now += seconds
+
+    def test_lock_timeout(self):
+        backend = CacheBackend('locmem://', shards=1, lock_timeout=0)
+        backend.cache.add('janrain:writebehind:lock:0', True, 10)
+        self.assertRaises(BackendUnavailable, backend.put, 'u1', 'user', dict(givenName='nate'))
+
+    def test_shard_size(self):
+        backend = CacheBackend('locmem://', shards=1, shard_size=2)
+        backend.put('u1', 'user', dict(n=1))
+        backend.put('u2', 'user', dict(n=2))
+        backend.put('u1', 'user', dict(n=3))
+        self.assertRaises(BackendUnavailable, backend.put, 'u3', 'user', dict(n=4))
+        self.assertEqual(backend.count(), 2)
+
+    def test_expired_entries_dropped(self):
+        self.backend.put('u1', 'user', dict(givenName='nate'))
+        self.backend.cache.delete(self.backend.key('user', 'u1'))
+        self.assertEqual(self.backend.take(10), [])
+        self.assertEqual(self.pending(), [])
+
+class TestWriteBehindQueue(TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.queue = WriteBehindQueue(self.client, max_attempts=2)
+
+    def test_flush_merged(self):
+        sent = []
+        def entity_update_many(updates, type_name, concurrency):
+            sent.extend(updates)
+            return [(uuid, dict(stat='ok'), None) for uuid, update in sent]
+        self.client.entity_update_many.side_effect = entity_update_many
+        self.queue.enqueue('u1', 'user', dict(givenName='nate'))
+        self.queue.enqueue('u1', 'user', dict(familyName='smith'))
+        self.assertEqual(self.queue.flush(), (1, 0))
+        self.assertEqual(sent, [('u1', dict(givenName='nate', familyName='smith'))])
+        self.assertEqual(self.queue.pending(), 0)
+
+    def test_failures(self):
+        self.client.entity_update_many.side_effect = lambda updates, type_name, concurrency: [
+            (uuid, None, IOError('down')) for uuid, update in updates]
+        received = []
+        def handler(sender, uuid, **kwargs):
+            received.append(uuid)
+        entity_update_failed.connect(handler)
+        try:
+            self.queue.enqueue('u1', 'user', dict(givenName='nate'))
+            self.assertEqual(self.queue.flush(), (0, 1))
+            self.assertEqual(self.queue.pending(), 1, 'kept for a retry')
+            self.assertEqual(self.queue.flush(), (0, 1))
+            self.assertEqual(self.queue.pending(), 0, 'given up')
+        finally:
+            entity_update_failed.disconnect(handler)
+        self.assertEqual(received, ['u1'])
+        self.assertEqual(self.queue.failures[0][:2], ('u1', 'user'))
+
+    def test_worker(self):
+        self.client.entity_update_many.side_effect = lambda updates, type_name, concurrency: [
+            (uuid, dict(stat='ok'), None) for uuid, update in updates]
+        self.queue.interval = 0.01
+        self.queue.start()
+        self.queue.enqueue('u1', 'user', dict(givenName='nate'))
+        self.queue.stop()
+        self.assertEqual(self.queue.pending(), 0)
+        self.assertTrue(self.client.entity_update_many.called)
+
+    def test_unavailable_sends_now(self):
+        backend = mock.Mock()
+        backend.put.side_effect = BackendUnavailable('cache down')
+        queue = WriteBehindQueue(self.client, backend)
+        queue.enqueue('u1', 'user', dict(givenName='nate'))
+        self.client.entity_update.assert_called_with('u1', 'user', dict(givenName='nate'))
+
+    def test_database_flush(self):
+        queue = WriteBehindQueue(self.client, DatabaseBackend(), max_attempts=2)
+        self.client.entity_update_many.side_effect = RuntimeError('process killed')
+        queue.enqueue('u1', 'user', dict(givenName='nate'))
+        self.assertRaises(RuntimeError, queue.flush)
+        self.assertEqual(PendingEntityUpdate.objects.count(), 1, 'survives a flush cut short')
+
+        PendingEntityUpdate.objects.update(claim='')
+        self.client.entity_update_many.side_effect = lambda updates, type_name, concurrency: [
+            (uuid, dict(stat='ok'), None) for uuid, update in updates]
+        self.assertEqual(queue.flush(), (1, 0))
+        self.assertEqual(PendingEntityUpdate.objects.count(), 0)
+
+        self.client.entity_update_many.side_effect = lambda updates, type_name, concurrency: [
+            (uuid, None, IOError('down')) for uuid, update in updates]
+        queue.enqueue('u1', 'user', dict(givenName='nate'))
+        queue.flush()
+        queue.flush()
+        self.assertEqual(PendingEntityUpdate.objects.count(), 0, 'given up')
+        PendingEntityUpdate.objects.all().delete()
+
+class TestCreateUnlessExists(TestCase):
+    def tearDown(self):
+        PendingEntityUpdate.objects.all().delete()
+
+    def test_duplicate(self):
+        self.assertTrue(create_unless_exists(PendingEntityUpdate, type_name='user', uuid='u1', value='{}'))
+        self.assertFalse(create_unless_exists(PendingEntityUpdate, type_name='user', uuid='u1', value='{}'))
+        self.assertEqual(PendingEntityUpdate.objects.count(), 1)
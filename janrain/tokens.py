@@ -0,0 +1,100 @@
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from janrain.api import APIException, get_pool
+
+class TokenStore(object):
+    """
+        Keeps the Capture access and refresh tokens handed out at login, per
+        user, in a Django cache so later calls on that user's behalf can reuse
+        them.
+
+        A token that is about to expire (within ``margin`` seconds) is still
+        handed out while a fresh one is fetched on the shared worker pool, so
+        the request path only waits on Janrain when a token has already
+        expired.
+    """
+    def __init__(self, client, cache, margin=60, timeout=30 * 24 * 3600):
+        self.client = client
+        self.cache = cache
+        self.margin = margin
+        # how long to remember a refresh token we haven't needed
+        self.timeout = timeout
+
+    def key(self, user_id):
+        return 'janrain:token:%s' % user_id
+
+    def save(self, user_id, response, refresh_token=None):
+        """
+        Remembers the tokens from an ``oauth_token`` or ``refresh_token``
+        response.
+
+        :param refresh_token: kept if the response doesn't hand out a new one
+        :returns: the access token
+        """
+        token = dict(
+            access_token=response['access_token'],
+            refresh_token=response.get('refresh_token') or refresh_token,
+            expires_at=time.time() + int(response.get('expires_in', 3600)),
+        )
+        self.cache.set(self.key(user_id), token, self.timeout)
+        return token['access_token']
+
+    def get(self, user_id):
+        """
+        :returns: a valid access token for user_id, or None
+        """
+        token = self.cache.get(self.key(user_id))
+        if token is None:
+            return None
+
+        remaining = token['expires_at'] - time.time()
+        if remaining <= 0:
+            return self.refresh(user_id, token)
+
+        # only one process gets to refresh ahead of time
+        if remaining < self.margin and token['refresh_token'] and \
+                self.cache.add(self.key(user_id) + ':refreshing', True, self.margin):
+            get_pool().apply_async(self.refresh, (user_id, token))
+
+        return token['access_token']
+
+    def refresh(self, user_id, token):
+        """
+        Trades token's refresh token for a new access token.
+
+        :returns: the new access token, or None if it can't be refreshed
+        """
+        if not token['refresh_token']:
+            self.forget(user_id)
+            return None
+
+        try:
+            response = self.client.refresh_token(token['refresh_token'])
+        except APIException:
+            return None
+
+        if response.get('stat') != 'ok' or 'access_token' not in response:
+            self.forget(user_id)
+            return None
+
+        return self.save(user_id, response, token['refresh_token'])
+
+    def forget(self, user_id):
+        self.cache.delete(self.key(user_id))
+
+def token_store(client=None):
+    """
+        The TokenStore configured by ``JANRAIN_TOKEN_CACHE`` (a dict with
+        ``BACKEND``, a ``CACHES`` alias, ``REFRESH_MARGIN`` and ``TIMEOUT`` in
+        seconds), or None when tokens aren't kept. ``client`` is only needed
+        to refresh tokens; a store without one can still save and forget.
+    """
+    conf = getattr(settings, 'JANRAIN_TOKEN_CACHE', None)
+    if not conf:
+        return None
+    return TokenStore(client, get_cache(conf.get('BACKEND', 'default')),
+        margin=conf.get('REFRESH_MARGIN', 60),
+        timeout=conf.get('TIMEOUT', 30 * 24 * 3600))
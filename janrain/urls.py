@@ -1,5 +1,5 @@
 from django.conf.urls.defaults import patterns, url
-from janrain.views import JanrainLoginView, JanrainLogoutView, JanrainLoginPageView, JanrainOauthRedirectView, JanrainReturnView, JanrainXDCommView
+from janrain.views import JanrainLoginView, JanrainLogoutView, JanrainLoginPageView, JanrainOauthRedirectView, JanrainReturnView, JanrainWebhookView, JanrainXDCommView
 
 urlpatterns = patterns('',
     url(r'^login/$', JanrainLoginView.as_view(), name='login'),
@@ -8,4 +8,5 @@ urlpatterns = patterns('',
     url(r'^xdcomm.html$', JanrainXDCommView.as_view(), name='xdcomm'),
     url(r'^return.html$', JanrainReturnView.as_view(), name='return'),
     url(r'^oauth_redirect$', JanrainOauthRedirectView.as_view(), name='oauth_redirect'),
+    url(r'^webhook$', JanrainWebhookView.as_view(), name='webhook'),
 )
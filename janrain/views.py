@@ -1,17 +1,47 @@
+from hashlib import sha1
 from urlparse import urljoin
+import threading
+import time
 
-from django.http import HttpResponseRedirect
+from django.http import (HttpResponse, HttpResponseBadRequest, HttpResponseForbidden,
+    HttpResponseNotModified, HttpResponseRedirect)
 from django.conf import settings
 from django.contrib import auth
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import render_to_response
 from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import never_cache
 
-from janrain.api import JanrainClient
+from janrain import instrumentation
+from janrain.api import APIException, get_client
+from janrain.tokens import token_store
+from janrain.webhooks import get_batcher, parse_events, verify
 
-from django.views.generic import View, TemplateView
+from django.views.generic import View
+
+def capture_client():
+    """
+        The shared Capture client for the current settings.
+    """
+    # api_url should be something like 'https://%s.janraincapture.com/' % app_id
+    return get_client(
+        settings.JANRAIN_CAPTURE_CLIENT_ID,
+        settings.JANRAIN_CAPTURE_CLIENT_SECRET,
+        settings.JANRAIN_CAPTURE_API_URL,
+    )
+
+def engage_client():
+    """
+        The shared Engage client for the current settings.
+    """
+    return get_client(
+        None,
+        settings.JANRAIN_API_KEY,
+        getattr(settings, 'JANRAIN_API_URL', 'https://rpxnow.com/api/v2/'),
+    )
 
 class JanrainView(View):
     """
@@ -38,25 +68,22 @@ class JanrainOauthRedirectView(JanrainView):
         except KeyError:
             return HttpResponseRedirect('/')
 
-        api_key = settings.JANRAIN_API_KEY
-        client_id = settings.JANRAIN_CAPTURE_CLIENT_ID
-        client_secret = settings.JANRAIN_CAPTURE_CLIENT_SECRET
-
         # construct the uri for this request
         protocol = 'https' if request.is_secure() else 'http'
         host = request.get_host()
         path = request.path
         redirect_uri = urljoin("%s://%s" % (protocol, host), path)
 
-        # api_url should be something like 'https://%s.janraincapture.com/' % app_id
-        api_url = settings.JANRAIN_CAPTURE_API_URL
-        client = JanrainClient(api_key, client_id, client_secret, endpoint=api_url)
+        client = capture_client()
 
-        response = client.oauth_token(
-            code=code,
-            redirect_uri=redirect_uri,
-            grant_type='authorization_code',
-        )
+        try:
+            response = client.oauth_token(
+                code=code,
+                redirect_uri=redirect_uri,
+                grant_type='authorization_code',
+            )
+        except APIException:
+            return HttpResponseRedirect('/')
 
         if not response or 'error' in response:
             print response
@@ -66,21 +93,102 @@ class JanrainOauthRedirectView(JanrainView):
             access_token = response['access_token']
         except KeyError:
             return HttpResponseRedirect('/')
+        token_response = response
 
-        response = client.entity(access_token=access_token)
+        try:
+            response = client.entity(access_token=access_token)
+        except APIException:
+            return HttpResponseRedirect('/')
 
         if not response.get('stat') == 'ok':
             return HttpResponseRedirect('/')
 
         user_data = response['result']
 
+        started = time.time()
         user = auth.authenticate(user_data=user_data)
         request.user = user
         auth.login(request, user)
+        if instrumentation.enabled():
+            instrumentation.emit('login', view='oauth_redirect', duration=time.time() - started)
+
+        # keep the tokens for later calls on this user's behalf
+        store = token_store(client)
+        if store is not None:
+            store.save(user.pk, token_response)
 
         return HttpResponseRedirect('/janrain/return.html')
 
-class JanrainReturnView(TemplateView):
+class JanrainWebhookView(JanrainView):
+    """
+        Receives Capture entity-change webhooks. Deliveries not signed with
+        ``JANRAIN_WEBHOOK_SECRET`` are refused; the rest are queued on the
+        change batcher and acknowledged straight away, without any call to
+        Janrain. See janrain.webhooks.
+    """
+    @method_decorator(csrf_exempt)
+    def post(self, request, *args, **kwargs):
+        body = request.body
+        if not verify(getattr(settings, 'JANRAIN_WEBHOOK_SECRET', None), body,
+                request.META.get('HTTP_X_JANRAIN_SIGNATURE')):
+            return HttpResponseForbidden()
+
+        try:
+            changed = parse_events(body)
+        except ValueError:
+            return HttpResponseBadRequest()
+
+        get_batcher().add(changed)
+        return HttpResponse(status=204)
+
+class StaticTemplateView(View):
+    """
+        Serves a template that needs no context. It's rendered once per
+        process and served as the same bytes every time, with a strong ETag,
+        Last-Modified and a long ``Cache-Control`` (``JANRAIN_STATIC_MAX_AGE``
+        seconds, default a day) so browsers and CDNs can keep it. Conditional
+        GETs that still match get a 304 without touching the template.
+    """
+    template_name = None
+    _rendered = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def rendered(cls):
+        try:
+            return cls._rendered[cls.template_name]
+        except KeyError:
+            with cls._lock:
+                if cls.template_name not in cls._rendered:
+                    content = render_to_string(cls.template_name).encode('utf-8')
+                    cls._rendered[cls.template_name] = (
+                        content,
+                        sha1(content).hexdigest(),
+                        int(time.time()),
+                    )
+                return cls._rendered[cls.template_name]
+
+    def get(self, request, *args, **kwargs):
+        content, etag, last_modified = self.rendered()
+
+        if 'HTTP_IF_NONE_MATCH' in request.META:
+            etags = parse_etags(request.META['HTTP_IF_NONE_MATCH'])
+            not_modified = etag in etags or '*' in etags
+        else:
+            since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+            not_modified = since is not None and since >= last_modified
+
+        if not_modified:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, content_type='text/html; charset=utf-8')
+        response['ETag'] = quote_etag(etag)
+        response['Last-Modified'] = http_date(last_modified)
+        response['Cache-Control'] = 'public, max-age=%d' % getattr(settings, 'JANRAIN_STATIC_MAX_AGE', 86400)
+        return response
+
+
+class JanrainReturnView(StaticTemplateView):
     template_name='return.html'
 
 
@@ -97,26 +205,30 @@ class JanrainLoginView(JanrainView):
         except KeyError:
             return HttpResponseRedirect('/')
 
-        api_key = settings.JANRAIN_API_KEY
-        api_url = getattr(settings, 'JANRAIN_API_URL', 'https://rpxnow.com/api/v2/')
-        # TODO this is now broken
-        client = JanrainClient(api_key, endpoint=api_url)
-
-        auth_info = client.auth_info(token)
+        try:
+            auth_info = engage_client().auth_info(token)
+        except APIException:
+            return HttpResponseRedirect('/')
 
         if not auth_info['stat'] == 'ok':
             return HttpResponseRedirect('/')
 
-        user = auth.authenticate(auth_info=auth_info)
+        started = time.time()
+        user = auth.authenticate(user_data=auth_info)
 
         request.user = user
         auth.login(request, user)
+        if instrumentation.enabled():
+            instrumentation.emit('login', view='login', duration=time.time() - started)
 
         return HttpResponseRedirect(request.GET.get('redirect_to', '/'))
 
 
 class JanrainLogoutView(JanrainView):
     def get(self, request, *args, **kwargs):
+        if getattr(settings, 'JANRAIN_TOKEN_CACHE', None) and request.user.is_authenticated():
+            # forgetting needs no client, so no Capture settings either
+            token_store().forget(request.user.pk)
         auth.logout(request)
         return HttpResponseRedirect(request.GET.get('redirect_to', '/'))
 
@@ -131,5 +243,5 @@ class JanrainLoginPageView(JanrainView):
         )
 
 
-class JanrainXDCommView(TemplateView):
+class JanrainXDCommView(StaticTemplateView):
     template_name='xdcomm.html'
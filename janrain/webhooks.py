@@ -0,0 +1,159 @@
+"""
+Receives Capture entity-change webhooks and tells local copies to drop stale
+entities.
+
+Deliveries are POSTed to ``janrain.views.JanrainWebhookView`` as a JSON list
+of events (or an object with an ``events`` list), each with a ``uuid`` and an
+optional ``entityType``, and signed with the hex HMAC-SHA256 of the body under
+``JANRAIN_WEBHOOK_SECRET`` in the ``X-Janrain-Signature`` header.
+
+Changed uuids are collected per entity type, so an entity changed many times
+in a burst is announced once, and sent every ``JANRAIN_WEBHOOK_INTERVAL``
+seconds as the ``janrain.signals.entity_changed`` signal. The Capture
+client's entity cache (or profile mirror) subscribes to it.
+"""
+import hashlib
+import hmac
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_connection
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import smart_str
+
+from janrain import codec
+from janrain.signals import entity_changed
+
+logger = logging.getLogger(__name__)
+
+def signature(secret, body):
+    return hmac.new(smart_str(secret), body, hashlib.sha256).hexdigest()
+
+def verify(secret, body, sent):
+    """
+    :returns: True if ``sent`` is the signature of body under secret
+    """
+    return bool(secret and sent) and constant_time_compare(signature(secret, body), sent)
+
+def parse_events(body):
+    """
+    Reads the changed entities out of a delivery.
+
+    :param body: the request body
+    :returns: dict of type_name to set of uuids
+    :raises: ValueError if the body isn't a delivery
+    """
+    events = codec.loads(body)
+    if isinstance(events, dict):
+        events = events.get('events')
+    if not isinstance(events, list):
+        raise ValueError('Expected a list of events')
+
+    changed = {}
+    for event in events:
+        if not isinstance(event, dict) or not event.get('uuid'):
+            raise ValueError('Event without a uuid: %r' % (event,))
+        changed.setdefault(event.get('entityType') or 'user', set()).add(event['uuid'])
+    return changed
+
+class ChangeBatcher(object):
+    """
+        Collects changed uuids per entity type and sends each distinct one
+        in an ``entity_changed`` signal every ``interval`` seconds, from a
+        daemon thread. With an interval of 0 every ``add`` is sent straight
+        away.
+    """
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self._worker = None
+        self._stopping = threading.Event()
+
+    def add(self, changed):
+        """
+        :param changed: dict of type_name to iterable of uuids
+        """
+        with self.lock:
+            for type_name, uuids in changed.items():
+                self.pending.setdefault(type_name, set()).update(uuids)
+        if not self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends everything pending. A failing receiver is logged and doesn't
+        stop the others, or the other types.
+
+        :returns: number of uuids sent
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for type_name, uuids in pending.items():
+            results = entity_changed.send_robust(sender=self.__class__, type_name=type_name, uuids=uuids)
+            for receiver, result in results:
+                if isinstance(result, Exception):
+                    logger.error('entity_changed receiver %r failed on %d %s uuids: %r',
+                        receiver, len(uuids), type_name, result)
+        return sum(len(uuids) for uuids in pending.values())
+
+    def start(self):
+        if self._worker is not None or not self.interval:
+            return
+        self._stopping.clear()
+        self._worker = threading.Thread(target=self._run, name='janrain-webhooks')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self, flush=True):
+        if self._worker is not None:
+            self._stopping.set()
+            self._worker.join()
+            self._worker = None
+        if flush:
+            self.flush()
+
+    def _run(self):
+        while True:
+            self._stopping.wait(self.interval)
+            if self._stopping.is_set():
+                return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Sending entity_changed failed')
+            finally:
+                # receivers may use the ORM; only request_finished closes
+                # connections otherwise, and the server drops idle ones
+                close_connection()
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+def get_batcher():
+    """
+        The process-wide ChangeBatcher, flushing every
+        ``JANRAIN_WEBHOOK_INTERVAL`` seconds (default 1). Its thread is
+        started on first use.
+    """
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = ChangeBatcher(getattr(settings, 'JANRAIN_WEBHOOK_INTERVAL', 1.0))
+            _batcher.start()
+        return _batcher
+
+def invalidate_entities(sender, type_name, uuids, **kwargs):
+    """
+        entity_changed receiver dropping the changed entities from the
+        Capture client's entity cache, or marking them stale in the profile
+        mirror. An in-process entity cache is only reached in the process
+        that received the webhook.
+    """
+    from janrain.views import capture_client
+    if not getattr(settings, 'JANRAIN_CAPTURE_API_URL', None):
+        return
+    cache = capture_client().entity_cache
+    if cache is not None:
+        cache.invalidate_many(uuids, type_name)
@@ -0,0 +1,452 @@
+"""
+Write-behind queue for Capture entity updates.
+
+    from janrain.writebehind import get_queue
+    get_queue().enqueue(uuid, 'user', {'givenName': 'Nate'})
+
+``enqueue`` returns straight away. Updates to the same entity are merged
+until they're flushed, in batches of ``entity_update_many`` calls, by a
+worker thread or by ``./manage.py janrain_flush_updates``. Configure with
+``JANRAIN_WRITE_BEHIND``; see the README.
+
+Reads made before a flush still see the old entity.
+"""
+from datetime import timedelta
+import json
+import logging
+import threading
+import time
+from uuid import uuid4
+import zlib
+
+try:
+    from collections import OrderedDict
+except ImportError: # python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import IntegrityError, close_connection, transaction
+from django.db.models import Q
+from django.dispatch import Signal
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Sent when an update is given up on after MAX_ATTEMPTS failed flushes.
+entity_update_failed = Signal(providing_args=['uuid', 'type_name', 'update', 'error'])
+
+def merge(base, update):
+    """
+    Merges update into a copy of base; nested dicts are merged, anything else
+    in update replaces what's in base.
+
+    :returns: dict
+    """
+    merged = dict(base)
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+def create_unless_exists(model, **values):
+    """
+    Creates a row in the caller's transaction, if any, behind a savepoint.
+
+    :returns: False if a row with the same unique values already exists
+    """
+    sid = transaction.savepoint() if transaction.is_managed() else None
+    try:
+        model.objects.create(**values)
+    except IntegrityError:
+        if sid is not None:
+            transaction.savepoint_rollback(sid)
+        return False
+    if sid is not None:
+        transaction.savepoint_commit(sid)
+    return True
+
+class MemoryBackend(object):
+    """
+        Keeps pending updates in this process. Fast, but lost on restart.
+    """
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, uuid, type_name, update, attempts=0):
+        key = (type_name, uuid)
+        with self.lock:
+            if key in self.pending:
+                pending, pending_attempts = self.pending[key]
+                self.pending[key] = (merge(pending, update), max(attempts, pending_attempts))
+            else:
+                self.pending[key] = (update, attempts)
+
+    def take(self, limit):
+        """
+        :returns: list of (uuid, type_name, update, attempts), removed from
+            the backend
+        """
+        with self.lock:
+            keys = list(self.pending)[:limit]
+            return [(uuid, type_name) + self.pending.pop((type_name, uuid))
+                for type_name, uuid in keys]
+
+    def done(self, uuid, type_name):
+        # take already removed it
+        pass
+
+    def retry(self, uuid, type_name, update, attempts, error):
+        # anything enqueued since was newer, so it goes on top
+        key = (type_name, uuid)
+        with self.lock:
+            newer, newer_attempts = self.pending.pop(key, ({}, 0))
+            self.pending[key] = (merge(update, newer), attempts)
+
+    def count(self):
+        return len(self.pending)
+
+class DatabaseBackend(object):
+    """
+        Keeps pending updates in the PendingEntityUpdate table, so they survive
+        restarts and can be flushed from any process.
+
+        ``take`` only claims rows; they are deleted by ``done`` once Capture
+        has them. Rows claimed by a flush that never finished, say because
+        its process was restarted, are taken again after ``lease`` seconds.
+        ``put`` runs in the caller's transaction rather than one of its own,
+        so it is safe to call from a view.
+    """
+    def __init__(self, lease=300):
+        self.lease = lease
+        self.claims = {}
+
+    def put(self, uuid, type_name, update, attempts=0):
+        from janrain.models import PendingEntityUpdate
+        while True:
+            try:
+                row = PendingEntityUpdate.objects.get(type_name=type_name, uuid=uuid)
+            except PendingEntityUpdate.DoesNotExist:
+                if create_unless_exists(PendingEntityUpdate, type_name=type_name, uuid=uuid,
+                        value=json.dumps(update), attempts=attempts):
+                    return
+                continue
+            # only if nobody else changed it since; a claimed row goes back to
+            # waiting, so the newer update is sent even if the claim succeeds
+            if PendingEntityUpdate.objects.filter(pk=row.pk, value=row.value).update(
+                    value=json.dumps(merge(json.loads(row.value), update)),
+                    claim='', claimed_at=None):
+                return
+
+    def waiting(self):
+        from janrain.models import PendingEntityUpdate
+        expired = timezone.now() - timedelta(seconds=self.lease)
+        return PendingEntityUpdate.objects.filter(Q(claim='') | Q(claimed_at__lt=expired))
+
+    def take(self, limit):
+        from janrain.models import PendingEntityUpdate
+        claim = uuid4().hex
+        with transaction.commit_on_success():
+            rows = list(self.waiting().select_for_update()[:limit])
+            PendingEntityUpdate.objects.filter(pk__in=[row.pk for row in rows]).update(
+                claim=claim, claimed_at=timezone.now())
+        for row in rows:
+            self.claims[(row.type_name, row.uuid)] = claim
+        return [(row.uuid, row.type_name, json.loads(row.value), row.attempts) for row in rows]
+
+    def done(self, uuid, type_name):
+        from janrain.models import PendingEntityUpdate
+        claim = self.claims.pop((type_name, uuid), None)
+        # a row put to since it was claimed has more to send, so it stays
+        PendingEntityUpdate.objects.filter(type_name=type_name, uuid=uuid, claim=claim).delete()
+
+    def retry(self, uuid, type_name, update, attempts, error):
+        from janrain.models import PendingEntityUpdate
+        # the row still holds update, plus anything put since
+        self.claims.pop((type_name, uuid), None)
+        PendingEntityUpdate.objects.filter(type_name=type_name, uuid=uuid).update(
+            attempts=attempts, last_error=error, claim='', claimed_at=None)
+
+    def count(self):
+        return self.waiting().count()
+
+class BackendUnavailable(Exception):
+    """
+        Raised by ``put`` when a backend can't keep an update right now.
+    """
+
+class CacheBackend(object):
+    """
+        Keeps pending updates in a Django cache, shared by every process using
+        it and as durable as that cache is.
+
+        Pending entities are listed in ``shards`` index entries, each guarded
+        by its own lock built on ``cache.add`` and holding at most
+        ``shard_size`` entities, so no index outgrows memcached's 1MB item
+        limit. As with DatabaseBackend, ``take`` only claims updates and
+        ``done`` deletes them; claims older than ``lease`` seconds are taken
+        again. ``put`` raises BackendUnavailable when a shard is full or its
+        lock can't be had within ``lock_timeout`` seconds, say because the
+        cache is down.
+    """
+    def __init__(self, alias='default', prefix='janrain:writebehind', timeout=7 * 24 * 3600,
+            lease=300, shards=16, shard_size=5000, lock_timeout=1.0):
+        self.cache = get_cache(alias)
+        self.prefix = prefix
+        self.timeout = timeout
+        self.lease = lease
+        self.shards = shards
+        self.shard_size = shard_size
+        self.lock_timeout = lock_timeout
+        self.claims = {}
+
+    def key(self, type_name, uuid):
+        return '%s:%s:%s' % (self.prefix, type_name, uuid)
+
+    def shard(self, type_name, uuid):
+        return zlib.crc32(self.key(type_name, uuid)) % self.shards
+
+    def index_key(self, shard):
+        return '%s:index:%d' % (self.prefix, shard)
+
+    def locked(self, shard, func, *args):
+        lock_key = '%s:lock:%d' % (self.prefix, shard)
+        deadline = time.time() + self.lock_timeout
+        while not self.cache.add(lock_key, True, 10):
+            if time.time() >= deadline:
+                raise BackendUnavailable('Timed out locking %s' % lock_key)
+            time.sleep(0.005)
+        try:
+            return func(shard, *args)
+        finally:
+            self.cache.delete(lock_key)
+
+    def _put(self, shard, uuid, type_name, update, attempts):
+        key = self.key(type_name, uuid)
+        pending = self.cache.get(key)
+        if pending is None:
+            index = self.cache.get(self.index_key(shard)) or []
+            if (type_name, uuid) not in index:
+                if len(index) >= self.shard_size:
+                    raise BackendUnavailable('%s is full' % self.index_key(shard))
+                index.append((type_name, uuid))
+                self.cache.set(self.index_key(shard), index, self.timeout)
+            pending = ({}, 0)
+        # unclaimed, so the newer update is sent even if the claim succeeds
+        self.cache.set(key, (merge(pending[0], update), max(attempts, pending[1]), None, None),
+            self.timeout)
+
+    def put(self, uuid, type_name, update, attempts=0):
+        self.locked(self.shard(type_name, uuid), self._put, uuid, type_name, update, attempts)
+
+    def _take(self, shard, limit):
+        index = self.cache.get(self.index_key(shard)) or []
+        keys = [self.key(type_name, uuid) for type_name, uuid in index]
+        entries = self.cache.get_many(keys)
+        now = time.time()
+        claim = uuid4().hex
+        items = []
+        for (type_name, uuid), key in zip(index, keys):
+            if key not in entries or len(items) >= limit:
+                continue
+            update, attempts, claimed, claimed_at = entries[key]
+            if claimed is None or now - claimed_at >= self.lease:
+                self.cache.set(key, (update, attempts, claim, now), self.timeout)
+                self.claims[(type_name, uuid)] = claim
+                items.append((uuid, type_name, update, attempts))
+        # drop the entities whose entries expired
+        live = [item for item, key in zip(index, keys) if key in entries]
+        if len(live) < len(index):
+            self.cache.set(self.index_key(shard), live, self.timeout)
+        return items
+
+    def take(self, limit):
+        items = []
+        for shard in range(self.shards):
+            if len(items) >= limit:
+                break
+            items.extend(self.locked(shard, self._take, limit - len(items)))
+        return items
+
+    def _done(self, shard, uuid, type_name, claim):
+        key = self.key(type_name, uuid)
+        pending = self.cache.get(key)
+        # an entry put to since it was claimed has more to send, so it stays
+        if pending is not None and pending[2] != claim:
+            return
+        self.cache.delete(key)
+        index = self.cache.get(self.index_key(shard)) or []
+        if (type_name, uuid) in index:
+            index.remove((type_name, uuid))
+            self.cache.set(self.index_key(shard), index, self.timeout)
+
+    def done(self, uuid, type_name):
+        claim = self.claims.pop((type_name, uuid), None)
+        if claim is not None:
+            self.locked(self.shard(type_name, uuid), self._done, uuid, type_name, claim)
+
+    def _retry(self, shard, uuid, type_name, update, attempts):
+        key = self.key(type_name, uuid)
+        pending = self.cache.get(key)
+        if pending is None:
+            self._put(shard, uuid, type_name, update, attempts)
+            return
+        # the entry still holds update, plus anything put since
+        self.cache.set(key, (pending[0], attempts, None, None), self.timeout)
+
+    def retry(self, uuid, type_name, update, attempts, error):
+        self.claims.pop((type_name, uuid), None)
+        self.locked(self.shard(type_name, uuid), self._retry, uuid, type_name, update, attempts)
+
+    def count(self):
+        now = time.time()
+        waiting = 0
+        for shard in range(self.shards):
+            index = self.cache.get(self.index_key(shard)) or []
+            entries = self.cache.get_many([self.key(type_name, uuid) for type_name, uuid in index])
+            waiting += sum(1 for update, attempts, claimed, claimed_at in entries.values()
+                if claimed is None or now - claimed_at >= self.lease)
+        return waiting
+
+class WriteBehindQueue(object):
+    """
+        Collects entity updates in ``backend`` and sends them to Capture in
+        batches of ``batch_size`` with ``concurrency`` calls in flight. A
+        failed update is put back for the next flush until it has failed
+        ``max_attempts`` times; then it's logged, kept in ``failures`` and
+        announced with the ``entity_update_failed`` signal.
+    """
+    def __init__(self, client, backend=None, batch_size=100, concurrency=4, interval=1.0, max_attempts=5):
+        self.client = client
+        self.backend = backend or MemoryBackend()
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.failures = []
+        self._worker = None
+        self._stopping = threading.Event()
+
+    def enqueue(self, uuid, type_name, update):
+        try:
+            self.backend.put(uuid, type_name, update)
+        except BackendUnavailable as e:
+            # late beats lost
+            logger.warning('Sending entity_update of %s %s now: %s', type_name, uuid, e)
+            self.client.entity_update(uuid, type_name, update)
+
+    def pending(self):
+        return self.backend.count()
+
+    def flush(self):
+        """
+        Sends everything pending, a batch at a time.
+
+        :returns: (number sent, number failed)
+        """
+        sent = failed = 0
+        while True:
+            items = self.backend.take(self.batch_size)
+            if not items:
+                return sent, failed
+
+            by_type = {}
+            for uuid, type_name, update, attempts in items:
+                by_type.setdefault(type_name, []).append((uuid, update, attempts))
+
+            for type_name, updates in by_type.items():
+                attempts = dict((uuid, (update, n)) for uuid, update, n in updates)
+                results = self.client.entity_update_many(
+                    ((uuid, update) for uuid, update, n in updates),
+                    type_name, concurrency=self.concurrency)
+                for uuid, response, exception in results:
+                    if exception is None and response.get('stat') == 'ok':
+                        self.backend.done(uuid, type_name)
+                        sent += 1
+                        continue
+                    failed += 1
+                    update, n = attempts[uuid]
+                    self.failed(uuid, type_name, update, n + 1, repr(exception) if exception else json.dumps(response))
+
+            if failed:
+                # leave the retries for the next flush
+                return sent, failed
+
+    def failed(self, uuid, type_name, update, attempts, error):
+        if attempts < self.max_attempts:
+            self.backend.retry(uuid, type_name, update, attempts, error)
+            return
+        self.backend.done(uuid, type_name)
+        logger.error('Giving up on entity_update of %s %s after %d attempts: %s',
+            type_name, uuid, attempts, error)
+        self.failures = self.failures[-99:] + [(uuid, type_name, update, error)]
+        entity_update_failed.send(sender=self.__class__, uuid=uuid, type_name=type_name,
+            update=update, error=error)
+
+    def start(self):
+        """
+            Flushes every ``interval`` seconds on a daemon thread.
+        """
+        if self._worker is not None:
+            return
+        self._stopping.clear()
+        self._worker = threading.Thread(target=self._run, name='janrain-write-behind')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self, flush=True):
+        if self._worker is not None:
+            self._stopping.set()
+            self._worker.join()
+            self._worker = None
+        if flush:
+            self.flush()
+
+    def _run(self):
+        while True:
+            self._stopping.wait(self.interval)
+            if self._stopping.is_set():
+                return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Write-behind flush failed')
+            finally:
+                # only request_finished closes connections otherwise, and the
+                # server drops idle ones
+                close_connection()
+
+_queue = None
+_queue_lock = threading.Lock()
+
+BACKENDS = dict(
+    memory=lambda conf: MemoryBackend(),
+    database=lambda conf: DatabaseBackend(lease=conf.get('LEASE', 300)),
+    cache=lambda conf: CacheBackend(conf.get('CACHE', 'default'), timeout=conf.get('TIMEOUT', 7 * 24 * 3600),
+        lease=conf.get('LEASE', 300)),
+)
+
+def get_queue():
+    """
+        The process-wide WriteBehindQueue configured by
+        ``JANRAIN_WRITE_BEHIND``, sending through the Capture client. With the
+        in-process backend its worker thread is started on first use.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            from janrain.views import capture_client
+            conf = getattr(settings, 'JANRAIN_WRITE_BEHIND', {})
+            backend = conf.get('BACKEND', 'memory')
+            _queue = WriteBehindQueue(capture_client(), BACKENDS[backend](conf),
+                batch_size=conf.get('BATCH_SIZE', 100),
+                concurrency=conf.get('CONCURRENCY', 4),
+                interval=conf.get('INTERVAL', 1.0),
+                max_attempts=conf.get('MAX_ATTEMPTS', 5),
+            )
+            if backend == 'memory' or conf.get('WORKER'):
+                _queue.start()
+        return _queue